@@ -1,24 +1,45 @@
        
 import logging
 import json
+import threading
+from collections import Counter
+from itertools import count, islice
 
-from wordcloud import WordCloud
-
-from crawler import BeautifulSoupCrawler
+from crawler import BeautifulSoupCrawler, AsyncBeautifulSoupCrawler, read_pages
 from summarizer import Summarizer
-from classifier import ContentClassifier
+from classifier import ContentClassifier, ContentTypes
 from llm import LLMModel
-from utils import normalize_text, nltk_lan_mapper
+from llm_metrics import metrics_scope
+from dedupe import NearDuplicateDetector
+from preclassifier import PreClassifier
+from pipeline import Pipeline, Stage
+from incremental import PreviousRun, content_hash, prompt_hash
+from tokens import count_tokens
+from summarizer import prompt_margin
+from wordfreq import WordFrequencies
+
 
+MAX_ANALYSIS_TOKENS = 8000
 
-AVG_WORD_LEN = 7 # chars
-MAX_NUM_WORDS = 4000 # words
-MAX_TXT_LENGTH = AVG_WORD_LEN * MAX_NUM_WORDS # chars
+# Stages that can be routed to their own model
+LLM_STAGES = ['classifier', 'page_summary', 'total_summary', 'analysis']
 
 
 logger = logging.getLogger(__name__)
 
 
+def iter_batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def drop_text(item):
+    # Excluded and duplicate pages only keep their record (url, title, hash, class)
+    item.pop('text_content', None)
+    item.pop('headings', None)
+
+
 SYS_PROMPT = """As a Competitive Analyst, your task is to compare the features of our product {product_name} 
       with the features of the competitor product following .
 
@@ -53,8 +74,29 @@ SYS_PROMPT = """As a Competitive Analyst, your task is to compare the features o
 
 
 class CompetitorAnalyzer:
-    def __init__(self, llm_model: LLMModel, product_name: str, product_desc: str) -> None:
+    def __init__(self, llm_model: LLMModel, product_name: str, product_desc: str,
+                 crawler_settings: dict | None = None, dedupe_threshold: float | None = None,
+                 classify_batch_size: int = 1, preclassifier: PreClassifier | None = None,
+                 stage_models: dict[str, LLMModel] | None = None, pipeline: dict | None = None) -> None:
         self.llm_model = llm_model
+        # Models of single stages (see LLM_STAGES), the other stages use `llm_model`
+        stage_models = stage_models or {}
+        unknown = set(stage_models) - set(LLM_STAGES)
+        if unknown:
+            raise ValueError(f"Unknown LLM stages {sorted(unknown)}, expected some of {LLM_STAGES}.")
+        self.models = {stage: stage_models.get(stage, llm_model) for stage in LLM_STAGES}
+        # Extra keyword arguments for the crawler, e.g. concurrency limits
+        self.crawler_settings = crawler_settings or {}
+        # Near-duplicate pages (SimHash similarity >= threshold) reuse the results
+        # of their representative page instead of calling the LLM again
+        self.dedupe_threshold = dedupe_threshold
+        # Pages classified per LLM call, 1 classifies every page on its own
+        self.classify_batch_size = classify_batch_size
+        # Obvious pages (e.g. /contact, /blog/...) are classified locally without the LLM
+        self.preclassifier = preclassifier
+        # Settings of the streaming mode (queue size, workers and batch size per stage),
+        # None runs crawl, classification and summaries one after the other
+        self.pipeline = pipeline
         product_name = product_name
         product_desc = product_desc
 
@@ -63,98 +105,300 @@ class CompetitorAnalyzer:
         # In most pages at begining only some meta infromaiton are saved
         self.txt_offset = 150 # chars
 
-        self.summarizer = Summarizer(self.llm_model)
-        self.classifier = ContentClassifier(self.llm_model)
+        self.summarizer = Summarizer(self.models['page_summary'])
+        self.total_summarizer = Summarizer(self.models['total_summary'])
+        self.classifier = ContentClassifier(self.models['classifier'])
+
+        # The answer of the analysis gets at most half of the context, the summaries the rest
+        analysis_model = self.models['analysis']
+        self.analysis_tokens = min(MAX_ANALYSIS_TOKENS, analysis_model.context_tokens // 2)
+        self.analysis_budget = (analysis_model.context_tokens - count_tokens(self.sys_prompt)
+                                - self.analysis_tokens - prompt_margin(analysis_model.context_tokens))
     
     def chat(self, content):
-        response = self.llm_model.chat(content, sys_prompt=self.sys_prompt, 
-                                       max_token=8000, temp=0.)
+        response = self.models['analysis'].chat(content, sys_prompt=self.sys_prompt, 
+                                       max_token=self.analysis_tokens, temp=0., tag="analysis")
 
         res = response.choices[0].message.content
         # Remove the newline character and the end-of-text identifier
         res = res.strip().replace("<|eot_id|>", "")
         return res
 
+    def chat_stream(self, content):
+        # Yields the analysis piece by piece, the pieces are not cleaned up like in `chat`
+        yield from self.models['analysis'].chat_stream(content, sys_prompt=self.sys_prompt,
+                                              max_token=self.analysis_tokens, temp=0., tag="analysis")
+
+    def filter_pages(self, items, detector, results, previous=None):
+        # Only pages that are not near-duplicates of an earlier page are classified
+        representatives = []
+        for item in items:
+            item.pop('links', None)
+            item['content_hash'] = content_hash(item['text_content'])
+            representative = detector.find_or_add(item['url'], item['text_content']) if detector else None
+            if representative is not None:
+                item['duplicate_of'] = representative
+            else:
+                representatives.append(item)
+
+        # Pages with the same text as in the previous run keep their class and summary
+        changed = []
+        for item in representatives:
+            page = previous.lookup(item['content_hash']) if previous else None
+            cls = ContentTypes(page['class']) if page else None
+            if page and (cls in self.classifier.exclude_types or page['summary'] is not None):
+                results[item['url']] = {'class': cls, 'summary': page['summary'],
+                                        'source': page['source'], 'reused': True}
+            else:
+                changed.append(item)
+
+        # The pre-classifier labels the obvious pages, the rest goes to the LLM
+        for item in changed:
+            cls = self.preclassifier.classify(item) if self.preclassifier else None
+            if cls is not None:
+                results[item['url']] = {'class': cls, 'summary': None, 'source': 'rules', 'reused': False}
+        return changed
+
+    def classify_items(self, items, results):
+        # Classify the pages that have no class yet
+        to_llm = [item for item in items if 'duplicate_of' not in item and item['url'] not in results]
+        contents = [f"url: {item['url']} \n\n {item['text_content'][self.txt_offset:]}" for item in to_llm]
+        if self.classify_batch_size > 1:
+            classes = self.classifier.classify_batch(contents, max_batch_size=self.classify_batch_size)
+        else:
+            classes = self.classifier.classify_many(contents)
+        for item, cls in zip(to_llm, classes):
+            results[item['url']] = {'class': cls, 'summary': None, 'source': 'llm', 'reused': False}
+
+    def summarize_items(self, items, results):
+        # Summarize the content of each kept page seperatly
+        kept = [item for item in items if 'duplicate_of' not in item
+                and results[item['url']]['summary'] is None
+                and results[item['url']]['class'] not in self.classifier.exclude_types]
+        page_summaries = self.summarizer.summarize_pages([item['text_content'][self.txt_offset:] for item in kept])
+        for item, summary in zip(kept, page_summaries):
+            results[item['url']]['summary'] = summary
+
+    def collect_pages(self, items, results, class_records):
+        # Duplicates copy the class and summary of their representative page
+        pages = []
+        for item in items:
+            result = results[item.get('duplicate_of', item['url'])]
+            cls = result['class']
+            duplicate = 'duplicate_of' in item
+            if duplicate:
+                drop_text(item)
+            class_records.append({'url': item['url'], 'title': item.get('title', ''), 'class': cls,
+                                  'source': 'duplicate' if duplicate else result['source'],
+                                  'content_hash': item['content_hash'],
+                                  'reused': not duplicate and result['reused']})
+            if cls in self.classifier.exclude_types:
+                continue
+            item['class'] = cls
+            item['summary'] = result['summary']
+            pages.append(item)
+        return pages
+
+    def run_pipeline(self, crawler, detector, results, class_records, previous, count_words, progress):
+        # Crawl, filter, classify and summarize as stages connected by bounded queues
+        settings = self.pipeline
+        order = {}
+        num_done = Counter()
+        lock = threading.Lock()
+
+        def crawl(emit):
+            def on_item(item):
+                emit(item)
+                num_done['crawl'] += 1
+                progress('crawl', num_done['crawl'], crawler.max_pages)
+            crawler.on_item = on_item
+            crawler.start()
+
+        def filter_stage(batch):
+            # A single worker, the near-duplicate detector and the word counts are not thread-safe
+            for item in batch:
+                order.setdefault(item['url'], len(order))
+                count_words(item)
+            self.filter_pages(batch, detector, results, previous)
+            return batch
+
+        def classify_stage(batch):
+            self.classify_items(batch, results)
+            return batch
+
+        def summarize_stage(batch):
+            self.summarize_items(batch, results)
+            # The pages wait for the end of the crawl, only the kept ones hold their text
+            for item in batch:
+                if 'duplicate_of' in item or results[item['url']]['class'] in self.classifier.exclude_types:
+                    drop_text(item)
+            with lock:
+                num_done['pages'] += len(batch)
+                progress('pages', num_done['pages'], num_done['crawl'])
+            return batch
+
+        batch_size = settings.get('batch_size', 8)
+        max_wait = settings.get('max_wait', 0.5)
+        pipeline = Pipeline([
+            Stage('filter', filter_stage),
+            Stage('classify', classify_stage, settings.get('classify_workers', 2), batch_size, max_wait),
+            Stage('summarize', summarize_stage, settings.get('summarize_workers', 2), batch_size, max_wait),
+        ], queue_size=settings.get('queue_size', 64))
+
+        # The pages leave the pipeline in any order, the results keep the crawl order
+        items = sorted(pipeline.run(crawl), key=lambda item: order[item['url']])
+        return self.collect_pages(items, results, class_records)
+
+    def classify_and_summarize(self, items, detector, results, class_records, previous=None):
+        changed = self.filter_pages(items, detector, results, previous)
+        self.classify_items(changed, results)
+        self.summarize_items(changed, results)
+        return self.collect_pages(items, results, class_records)
+
     def analyze(self, base_folder, name: str, allowed_domains: list[str], 
             start_urls: list[str], languages: list[str], 
-            max_pages: int = 5):
-        
+            max_pages: int = 5, on_token=None, previous_folder=None, on_progress=None):
+        # With `on_token` the analysis is streamed, the callback gets each piece of text as it arrives.
+        # With `previous_folder` (the folder of an earlier run of the competitor) unchanged pages
+        # reuse their class and summary. `on_progress(stage, done, total)` is called as the
+        # stages (crawl, pages, total_summary, analysis) advance.
+        # The LLM calls are counted under the competitor name and saved next to the results.
+        metrics = self.llm_model.metrics
+        metrics.clear(name)
+        with metrics_scope(name):
+            try:
+                return self._analyze(base_folder, name, allowed_domains, start_urls,
+                                     languages, max_pages, on_token, previous_folder, on_progress)
+            finally:
+                metrics.save(f"{base_folder}/llm_metrics_{name}.json", scope=name)
+
+    def _analyze(self, base_folder, name, allowed_domains, start_urls, languages, max_pages, on_token,
+                 previous_folder, on_progress):
         logger.info(f"Running competitor analysis for '{name}'.")
 
-        crawler_file = f'{base_folder}/content_{name}.json'
+        crawler_file = f'{base_folder}/content_{name}.jsonl'
         wordcloud_file = f'{base_folder}/wordcloud_{name}.png'
+        wordfreq_file = f'{base_folder}/wordfreq_{name}.json'
         summary_file = f"{base_folder}/summaries_{name}.json"
+        classes_file = f"{base_folder}/classes_{name}.json"
         res_file = f"{base_folder}/res_competitor_analysis_{name}.txt"
         
-        # Start crawling
-        process = BeautifulSoupCrawler(
+        # Start crawling, fetch pages concurrently if configured
+        crawler_settings = dict(self.crawler_settings)
+        if crawler_settings.get('concurrency', 1) > 1:
+            crawler_cls = AsyncBeautifulSoupCrawler
+        else:
+            crawler_cls = BeautifulSoupCrawler
+            crawler_settings.pop('concurrency', None)
+            crawler_settings.pop('per_domain_concurrency', None)
+
+        process = crawler_cls(
             name=name,
             allowed_domains=allowed_domains,
             start_urls=start_urls,
             languages=languages,
             out_file=crawler_file,
-            max_pages=max_pages
+            max_pages=max_pages,
+            **crawler_settings
         )
-        process.start()
-        
-        # Load the extracted data from the JSON file
-        with open(crawler_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        ### Building the word cloud ###############################
 
-        # Concatenate all the orignial text contents into a single string
-        org_contents = " ".join([item['text_content'] for item in data])
+        # Count the words page by page without stopwords and the name of the company
+        word_freqs = WordFrequencies(languages, exclude=[name])
+
+        def count_words(item):
+            word_freqs.add(item['text_content'])
+
+        ### Classifing, filtering and summarizing ###############
+
+        detector = NearDuplicateDetector(self.dedupe_threshold) if self.dedupe_threshold else None
+        previous = PreviousRun(previous_folder, name) if previous_folder else None
+        results = {}
+        class_records = []
+        progress = on_progress or (lambda stage, done=None, total=None: None)
+        if self.pipeline is not None:
+            # Pages are classified and summarized while the crawl is still running
+            summaries = self.run_pipeline(process, detector, results, class_records, previous,
+                                          count_words, progress)
+        else:
+            num_crawled = count(1)
+            process.on_item = lambda item: progress('crawl', next(num_crawled), max_pages)
+            process.start()
+            for item in read_pages(crawler_file):
+                count_words(item)
+
+            # Pages are read in windows, the LLM calls of a window run concurrently
+            # and only the kept pages stay in memory
+            summaries = []
+            window_size = max(1, 2 * max(self.models['classifier'].max_concurrency,
+                                         self.models['page_summary'].max_concurrency))
+            for window in iter_batches(read_pages(crawler_file), window_size):
+                summaries.extend(self.classify_and_summarize(window, detector, results, class_records, previous))
+                progress('pages', len(class_records), process.counter)
+
+        ### Building the word cloud ###############################
 
-        # normalize the text
-        langs = [nltk_lan_mapper[lan] for lan in languages]
-        org_contents = normalize_text(org_contents, langs)
-        # remove also the name of the company
-        org_contents = org_contents.replace(name, "")
+        # Save the counts, so the cloud can be re-rendered or merged with other competitors
+        word_freqs.save(wordfreq_file)
 
         # Generate and save the word cloud
         logger.info("Generating word cloud.")
-        wordcloud = WordCloud(width=800, height=800, background_color='white').generate(org_contents)
-        wordcloud.to_file(wordcloud_file)
-
-        ### Classifing the content and filtering ################
-
-        filtered_data = []
-        for item in data:
-            txt = item['text_content'][self.txt_offset:]
-            txt = f"url: {item['url']} \n\n {txt}"
-            cls = self.classifier.classify(txt)
-            if cls in self.classifier.exclude_types:
-                continue
-            item['class'] = cls
-            filtered_data.append(item)
-
-
-        ### Summarizing #########################################
-
-        # Summarize the content of each page seperatly
-        summaries = []
-        for item in filtered_data:
-            txt = item['text_content'][self.txt_offset:]
-            summary = self.summarizer.summarize(txt)
-            item['summary'] = summary
-            summaries.append(item)
-
-        # Concatenate all the text content into a single string
-        content = " .".join([item['summary'] for item in summaries])
-        
-        content = content[:min(len(content), MAX_TXT_LENGTH)]
-
-        # Summarize the entire company text
-        summary = self.summarizer.summarize(content=content)
-        summaries.append({"total_summary": summary})
+        word_freqs.render(wordcloud_file)
+
+        # The classes of all pages, also of the excluded ones, e.g. to train the pre-classifier
+        with open(classes_file, 'w', encoding='utf-8') as f:
+            json.dump(class_records, f, ensure_ascii=False, indent=4)
+
+        if self.preclassifier:
+            num_local = sum(record['source'] == 'rules' for record in class_records)
+            logger.info(f"Pre-classifier avoided {num_local} of {len(class_records)} LLM classifications.")
+
+        if previous:
+            num_reused = sum(record['reused'] for record in class_records)
+            logger.info(f"Reused the results of {num_reused} of {len(class_records)} pages with unchanged text.")
+
+        if detector:
+            num_duplicates = sum('duplicate_of' in item for item in summaries)
+            logger.info(f"Skipped LLM calls for {num_duplicates} near-duplicate pages.")
+
+        # Duplicates are only counted once
+        page_summaries = [item['summary'] for item in summaries if 'duplicate_of' not in item]
+
+        # The total summary and the analysis only change if a page summary changed
+        unchanged = previous is not None and previous.same_summaries(page_summaries)
+        if unchanged and previous.total_summary is not None:
+            logger.info("Page summaries are unchanged, reusing the total summary.")
+            summary = previous.total_summary
+        else:
+            # Summarize the entire company text, summaries that don't fit in one request are reduced first
+            progress('total_summary')
+            summary = self.total_summarizer.reduce(page_summaries, tag="total_summary")
+        analysis_prompt_hash = prompt_hash(self.sys_prompt)
+        summaries.append({"total_summary": summary, "analysis_prompt_hash": analysis_prompt_hash})
 
         # Save the extracted data to a JSON file
         with open(summary_file, 'w', encoding='utf-8') as f:
             json.dump(summaries, f, ensure_ascii=False, indent=4)
 
         ### Analyze the competitor #############################
-        res = self.chat(content)
+        progress('analysis')
+        if (unchanged and previous.analysis is not None
+                and previous.analysis_prompt_hash == analysis_prompt_hash):
+            # Same summaries and same product description as in the previous run
+            logger.info("Page summaries are unchanged, reusing the competitor analysis.")
+            res = previous.analysis
+            if on_token is not None:
+                on_token(res)
+        else:
+            content = " .".join(self.total_summarizer.condense(page_summaries, self.analysis_budget,
+                                                               tag="analysis_input"))
+            if on_token is None:
+                res = self.chat(content)
+            else:
+                parts = []
+                for piece in self.chat_stream(content):
+                    parts.append(piece)
+                    on_token(piece)
+                res = "".join(parts).strip().replace("<|eot_id|>", "")
 
         with open(res_file, 'w', encoding='utf-8') as f:
             f.write(res)
@@ -1,17 +1,35 @@
 import os
-import shutil
+import glob
+import time
 import yaml
 import json
+import logging
 
 import streamlit as st
 from streamlit_option_menu import option_menu
 
-from analyzer import CompetitorAnalyzer
-from llm import LLMModel
+from analyzer import CompetitorAnalyzer, LLM_STAGES
+from llm import create_llm_models
+from jobs import JobRunner
+from store import ResultsStore
 
 
+logger = logging.getLogger(__name__)
+
 DEFAULT_ROOT_FOLDER = "results"
+RESULTS_STORE_PATH = f"{DEFAULT_ROOT_FOLDER}/results.sqlite"
+EMBEDDINGS_FOLDER = f"{DEFAULT_ROOT_FOLDER}/embeddings"
 LOGO_PATH = "logo.png"
+# Analyses running at the same time, and how often a running one is refreshed
+JOB_WORKERS = 2
+JOB_POLL_SECONDS = 1
+STAGE_LABELS = {
+    "crawl": "Crawling pages",
+    "pages": "Classifying and summarizing pages",
+    "total_summary": "Summarizing the website",
+    "analysis": "Writing the analysis",
+    "embeddings": "Indexing the summaries for search",
+}
 
 
 def main():
@@ -32,8 +50,8 @@ def main():
     with st.sidebar:
         selected_page = option_menu(
             menu_title=None,
-            options=["Home", "Settings", "Competitors", "Analysis"],
-            icons=["house", "gear", "people", "graph-up"],
+            options=["Home", "Settings", "Competitors", "Analysis", "Search"],
+            icons=["house", "gear", "people", "graph-up", "search"],
             default_index=0,
             styles={
                 "container": {"padding": "5!important", "background-color": "#f5f5f5"},
@@ -49,6 +67,8 @@ def main():
         competitors_page(primary_color, secondary_color)
     elif selected_page == "Analysis":
         analysis_page(primary_color, secondary_color)
+    elif selected_page == "Search":
+        search_page(primary_color, secondary_color)
     elif selected_page == "Settings":
         settings_page(primary_color, secondary_color)
 
@@ -150,6 +170,205 @@ def competitors_page(primary_color, secondary_color):
         st.experimental_rerun()
 
 
+# Background jobs outlive the script run that starts them, the runner and the
+# LLM clients are shared by all sessions of the server
+@st.cache_resource
+def get_job_runner():
+    return JobRunner(max_workers=JOB_WORKERS)
+
+
+@st.cache_resource
+def get_results_store():
+    return ResultsStore(RESULTS_STORE_PATH)
+
+
+@st.cache_resource
+def get_embedding_index():
+    # Embeddings (and numpy) are only imported once search or indexing is used
+    from embeddings import EmbeddingIndex
+    return EmbeddingIndex(EMBEDDINGS_FOLDER)
+
+
+@st.cache_resource
+def get_embedder(api_url, api_key, model_name):
+    from embeddings import create_embedder
+    return create_embedder(dict(url=api_url, api_key=api_key, model_name=model_name))
+
+
+def load_embedder(config):
+    # None while no embedding model is set, search and indexing are off then
+    model_name = config.get("embeddings", {}).get("model_name")
+    if not model_name:
+        return None
+    return get_embedder(config["openai"]["api_url"], config["openai"]["api_key"], model_name)
+
+
+@st.cache_resource
+def get_llm_models(api_url, api_key, model_name, stage_models_json):
+    return create_llm_models(dict(url=api_url, api_key=api_key, model_name=model_name),
+                             json.loads(stage_models_json))
+
+
+@st.cache_data
+def load_analysis_text(path, mtime):
+    # `mtime` is part of the cache key, a rewritten file is read again
+    with open(path, "r") as f:
+        return f.read()
+
+
+def latest_analysis_folder(name):
+    # The folder of the latest complete analysis of the competitor, analyses
+    # from before the results store are found in the job folders
+    run = get_results_store().latest_run(name)
+    if run is not None and os.path.exists(run["folder"]):
+        return run["folder"]
+    folders = sorted(glob.glob(f"{DEFAULT_ROOT_FOLDER}/{name}/*/"), reverse=True)
+    for folder in folders:
+        folder = folder.rstrip("/")
+        if os.path.exists(f"{folder}/summaries_{name}.json") and \
+           os.path.exists(f"{folder}/res_competitor_analysis_{name}.txt"):
+            return folder
+    return None
+
+
+def run_analysis_job(job, analyzer, store, embedder, product_name, competitor, languages, max_pages):
+    name = competitor["name"]
+    # Each job writes its own folder, the last complete one provides the unchanged pages
+    previous_folder = latest_analysis_folder(name)
+    base_folder = f"{DEFAULT_ROOT_FOLDER}/{name}/{time.strftime('%Y%m%d_%H%M%S')}_{job.id}"
+    os.makedirs(base_folder)
+    started_at = time.time()
+    try:
+        result = analyzer.analyze(base_folder=base_folder, name=name,
+                                  allowed_domains=competitor["allowed_domains"], start_urls=competitor["start_urls"],
+                                  languages=languages, max_pages=max_pages,
+                                  on_token=job.append_text, on_progress=job.progress,
+                                  previous_folder=previous_folder)
+    except Exception as ex:
+        store.record_run(name, base_folder, product=product_name, source="app", status="failed",
+                         error=f"{type(ex).__name__}: {ex}", started_at=started_at)
+        raise
+    store.record_run(name, base_folder, product=product_name, source="app", started_at=started_at)
+    if embedder is not None:
+        # The analysis is complete, a failing index only costs the search
+        job.progress("embeddings")
+        try:
+            from embeddings import index_folder
+            index = get_embedding_index()
+            index_folder(index, embedder, base_folder, name)
+            index.save()
+        except Exception:
+            logger.exception(f"Embedding the summaries of '{name}' failed.")
+    return result
+
+
+def show_analysis(analysis_res_file, wordcloud_file):
+    # Display analysis results and word cloud side by side
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.subheader("Analysis Results")
+        # Read the competitor analysis text from the saved file
+        if analysis_res_file and os.path.exists(analysis_res_file):
+            analysis_text = load_analysis_text(analysis_res_file, os.path.getmtime(analysis_res_file))
+
+            # Split the analysis text into sections
+            sections = analysis_text.split("\n\n")
+            st.markdown(sections[0])
+
+            # Display each section in an expander
+            for section in sections[1:]:
+                lines = section.strip().split("\n")
+                if lines:
+                    title = lines[0].strip("1234567890. ")
+                    content = "\n".join(lines[1:])
+                    with st.expander(title, expanded=True):
+                        st.markdown(content)
+        else:
+            st.warning("Analysis result not found.")
+
+    with col2:
+        st.subheader("Word Cloud")
+        # Display the word cloud image from the saved file
+        if wordcloud_file and os.path.exists(wordcloud_file):
+            st.image(wordcloud_file, use_column_width=True)
+        else:
+            st.warning("Word cloud image not found.")
+
+
+def show_job(job_id):
+    job = get_job_runner().get(job_id)
+    if job is None:
+        st.info("The analysis job is no longer known to the server, start it again.")
+        return
+    state = job.snapshot()
+
+    if state["status"] == "queued":
+        st.info("Waiting for a free worker...")
+    elif state["status"] == "running":
+        stage = state["stage"] or "crawl"
+        done, total = state["stages"].get(stage, (0, None))
+        label = STAGE_LABELS.get(stage, stage)
+        if total:
+            st.progress(min(done / total, 1.), text=f"{label} ({done}/{total})")
+        else:
+            st.progress(0., text=f"{label} ({done} done)" if done else label)
+        if state["text"]:
+            # The analysis is shown while it is generated
+            st.subheader("Analysis Results")
+            st.markdown(state["text"].replace("<|eot_id|>", ""))
+    elif state["status"] == "failed":
+        st.error(f"Analysis failed: {state['error']}")
+    else:
+        analysis_res_file, wordcloud_file, _, _ = state["result"]
+        st.success(f"Analysis finished in {state['finished_at'] - state['started_at']:.0f}s.")
+        show_analysis(analysis_res_file, wordcloud_file)
+
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+
+def show_history(name):
+    store = get_results_store()
+    runs = store.runs(name, limit=20)
+    if not runs:
+        return
+
+    with st.expander("History", expanded=False):
+        st.dataframe([{"Run": run["id"], "Started": format_time(run["started_at"]), "Status": run["status"],
+                       "Pages": run["num_pages"], "From": run["source"], "Error": run["error"] or ""}
+                      for run in runs], use_container_width=True, hide_index=True)
+
+        ok_runs = [run for run in runs if run["status"] == "ok"]
+        if len(ok_runs) < 2:
+            return
+        # Latest run against an earlier one, the run before it by default
+        labels = {run["id"]: f"Run {run['id']} ({format_time(run['started_at'])})" for run in ok_runs}
+        old_run = st.selectbox("Compare the latest run with", [run["id"] for run in ok_runs[1:]],
+                               format_func=labels.get, key=f"diff_{name}")
+        diff = store.diff(old_run, ok_runs[0]["id"])
+
+        st.markdown(f"**{len(diff['added'])}** new, **{len(diff['removed'])}** removed, "
+                    f"**{len(diff['changed'])}** changed and **{len(diff['reclassified'])}** reclassified pages, "
+                    f"{diff['num_unchanged']} unchanged. "
+                    + ("The analysis changed." if diff["analysis_changed"] else "The analysis is the same."))
+        for title, pages in (("New pages", diff["added"]), ("Removed pages", diff["removed"])):
+            if pages:
+                st.markdown(f"**{title}**")
+                st.dataframe([{"URL": page["url"], "Title": page["title"], "Class": page["class"]} for page in pages],
+                             use_container_width=True, hide_index=True)
+        if diff["changed"]:
+            st.markdown("**Changed pages**")
+            st.dataframe([{"URL": page["url"], "Old summary": page["old_summary"] or "",
+                           "New summary": page["new_summary"] or ""} for page in diff["changed"]],
+                         use_container_width=True, hide_index=True)
+        if diff["reclassified"]:
+            st.markdown("**Reclassified pages**")
+            st.dataframe([{"URL": page["url"], "Old class": page["old_class"], "New class": page["new_class"]}
+                          for page in diff["reclassified"]], use_container_width=True, hide_index=True)
+
+
 def analysis_page(primary_color, secondary_color):
     st.title("Analysis")
     
@@ -164,64 +383,99 @@ def analysis_page(primary_color, secondary_color):
     config = load_config()
     languages = config["settings"]["languages"]
     max_pages = config["settings"]["max_pages"]
-    llm_model = LLMModel(config["openai"]["api_url"], config["openai"]["api_key"], config["llm"]["model_name"])
+    stage_models_json = json.dumps(config["llm"].get("models", {}), sort_keys=True)
+
+    runner = get_job_runner()
+    session_jobs = st.session_state.setdefault("analysis_jobs", {})
     
     start_button = st.button("Start Analysis", key="start_analysis")
     
-    if start_button:
+    if start_button and selected_competitor:
         competitor = next(c for c in competitors if c["name"] == selected_competitor)
-
-        compat_name = competitor["name"]
-        allowed_domains = competitor["allowed_domains"]
-        start_urls = competitor["start_urls"]
-
+        llm_model, stage_models = get_llm_models(config["openai"]["api_url"], config["openai"]["api_key"],
+                                                 config["llm"]["model_name"], stage_models_json)
         analyzer = CompetitorAnalyzer(llm_model=llm_model, 
+                                      stage_models=stage_models,
                                       product_name=product_name, 
                                       product_desc=product_desc)
-        
-        base_folder = f"{DEFAULT_ROOT_FOLDER}/{compat_name}"
-        shutil.rmtree(base_folder, ignore_errors=True)
-        os.makedirs(base_folder)
-
-        with st.spinner("Analyzing competitor..."):
-            analysis_res_file, wordcloud_file, _, _ = analyzer.analyze(base_folder=base_folder, name=compat_name, 
-                                                                       allowed_domains=allowed_domains, start_urls=start_urls, 
-                                                                       languages=languages, max_pages=max_pages)
-        
-        # Display analysis results and word cloud side by side
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            st.subheader("Analysis Results")
-            
-            # Read the competitor analysis text from the saved file
-            if os.path.exists(analysis_res_file):
-                with open(analysis_res_file, "r") as f:
-                    analysis_text = f.read()
-                
-                # Split the analysis text into sections
-                sections = analysis_text.split("\n\n")
-                st.markdown(sections[0])
-
-                # Display each section in an expander
-                for section in sections[1:]:
-                    lines = section.strip().split("\n")
-                    if lines:
-                        title = lines[0].strip("1234567890. ")
-                        content = "\n".join(lines[1:])
-                        with st.expander(title, expanded=True):
-                            st.markdown(content)
-            else:
-                st.warning("Analysis result not found.")
-        
-        with col2:
-            st.subheader("Word Cloud")
-            
-            # Display the word cloud image from the saved file
-            if os.path.exists(wordcloud_file):
-                st.image(wordcloud_file, use_column_width=True)
-            else:
-                st.warning("Word cloud image not found.")
+
+        # The same analysis started twice (e.g. from two tabs) runs only once
+        key = json.dumps([competitor, product_name, product_desc, languages, max_pages,
+                          config["llm"]["model_name"], stage_models_json], sort_keys=True)
+        job = runner.submit(key, selected_competitor, run_analysis_job,
+                            analyzer, get_results_store(), load_embedder(config),
+                            product_name, competitor, languages, max_pages)
+        session_jobs[selected_competitor] = job.id
+
+    job_id = session_jobs.get(selected_competitor)
+    if job_id is not None:
+        # Polled without blocking the page, older Streamlit versions refresh on demand
+        fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+        if fragment is not None:
+            fragment(run_every=JOB_POLL_SECONDS)(show_job)(job_id)
+        else:
+            show_job(job_id)
+            st.button("Refresh", key="refresh_job")
+    elif selected_competitor:
+        # Results of the last complete analysis
+        folder = latest_analysis_folder(selected_competitor)
+        if folder is not None:
+            st.caption(f"Last analysis: {os.path.basename(folder)}")
+            show_analysis(f"{folder}/res_competitor_analysis_{selected_competitor}.txt",
+                          f"{folder}/wordcloud_{selected_competitor}.png")
+
+    if selected_competitor:
+        show_history(selected_competitor)
+
+    jobs = runner.list()
+    if jobs:
+        with st.expander("Background Jobs", expanded=False):
+            for job in jobs:
+                state = job.snapshot()
+                stage = f", {STAGE_LABELS.get(state['stage'], state['stage'])}" if state["stage"] and not job.finished else ""
+                submitted = time.strftime("%H:%M:%S", time.localtime(state["submitted_at"]))
+                st.markdown(f"**{state['description']}** - {state['status']}{stage} (started {submitted})")
+
+
+def search_page(primary_color, secondary_color):
+    st.title("Search")
+    st.write("Find the pages of all competitors and analyses that talk about a topic.")
+
+    config = load_config()
+    embedder = load_embedder(config)
+    if embedder is None:
+        st.info("Set an embedding model in the settings to search the analyzed pages.")
+        return
+    index = get_embedding_index()
+    if len(index) == 0:
+        st.info("No summaries indexed yet, run an analysis first.")
+        return
+    if index.model_name != embedder.model_name:
+        st.warning(f"The summaries were indexed with '{index.model_name}', set it as embedding model "
+                   f"or delete '{EMBEDDINGS_FOLDER}' to index the next analyses with '{embedder.model_name}'.")
+        return
+
+    query = st.text_input("Search", placeholder="e.g. real-time dashboards")
+    col1, col2, col3 = st.columns([2, 1, 1])
+    with col1:
+        competitors = st.multiselect("Competitors", sorted({entry["competitor"] for entry in index.meta}))
+    with col2:
+        k = st.number_input("Results", value=10, min_value=1, max_value=100)
+    with col3:
+        latest_only = st.checkbox("Latest analysis only", value=True)
+
+    if not query:
+        return
+    hits = index.query(embedder, query, k=k, competitors=competitors or None, latest_only=latest_only)
+    if not hits:
+        st.warning("Nothing found.")
+    for hit in hits:
+        title = hit["title"] or hit["url"]
+        with st.expander(f"{hit['competitor']} - {title} ({hit['score']:.2f})", expanded=True):
+            if hit["url"]:
+                st.markdown(f"[{hit['url']}]({hit['url']}) - {hit['class']}")
+            st.caption(f"Analysis of {hit['last_run']}")
+            st.markdown(hit["text"])
 
 
 def settings_page(primary_color, secondary_color):
@@ -238,6 +492,17 @@ def settings_page(primary_color, secondary_color):
     # LLM settings
     st.subheader("LLM Settings")
     llm_model = st.text_input("LLM Model Name", value=config["llm"]["model_name"])
+
+    # Stages left empty use the model above
+    stage_models = dict(config["llm"].get("models", {}))
+    stage_names = {}
+    for stage in LLM_STAGES:
+        current = stage_models.get(stage, {}).get("model_name", "")
+        stage_names[stage] = st.text_input(f"Model for {stage.replace('_', ' ')} (optional)", value=current)
+    
+    # Search needs an embeddings endpoint, the chat models often don't have one
+    embedding_model = st.text_input("Embedding Model Name (optional, enables search)",
+                                    value=config.get("embeddings", {}).get("model_name", ""))
     
     # Other settings
     st.subheader("Other Settings")
@@ -247,13 +512,28 @@ def settings_page(primary_color, secondary_color):
     save_button = st.button("Save Settings", key="save_settings")
     
     if save_button:
+        for stage, stage_name in stage_names.items():
+            # Other settings of a stage (e.g. its endpoint) are kept
+            stage_settings = dict(stage_models.get(stage, {}))
+            stage_settings.pop("model_name", None)
+            if stage_name.strip():
+                stage_settings["model_name"] = stage_name.strip()
+            if stage_settings:
+                stage_models[stage] = stage_settings
+            else:
+                stage_models.pop(stage, None)
+
         settings = {
             "openai": {
                 "api_url": api_url,
                 "api_key": api_key
             },
             "llm": {
-                "model_name": llm_model
+                "model_name": llm_model,
+                "models": stage_models
+            },
+            "embeddings": {
+                "model_name": embedding_model.strip()
             },
             "settings": {
                 "max_pages": max_pages,
@@ -264,6 +544,9 @@ def settings_page(primary_color, secondary_color):
         st.success("Settings saved successfully!")
 
 
+# Loaded files are cached per server, saving a file clears its cache. The
+# defaults are written without `save_*`, which would clear the cache being filled.
+@st.cache_data
 def load_config():
     try:
         with open(f"{DEFAULT_ROOT_FOLDER}/config.yaml", "r") as f:
@@ -282,13 +565,18 @@ def load_config():
                 "languages": ["en"],
             }
         }
-        save_config(config)
+        write_config(config)
     return config
 
-def save_config(config):
+def write_config(config):
     with open(f"{DEFAULT_ROOT_FOLDER}/config.yaml", "w") as f:
         yaml.dump(config, f)
 
+def save_config(config):
+    write_config(config)
+    load_config.clear()
+
+@st.cache_data
 def load_competitors():
     try:
         with open(f"{DEFAULT_ROOT_FOLDER}/competitors.json", "r") as f:
@@ -300,20 +588,26 @@ def load_competitors():
 def save_competitors(competitors):
     with open(f"{DEFAULT_ROOT_FOLDER}/competitors.json", "w") as f:
         json.dump(competitors, f)
+    load_competitors.clear()
 
+@st.cache_data
 def load_product_info():
     try:
         with open(f"{DEFAULT_ROOT_FOLDER}/product_info.json", "r") as f:
             product_info = json.load(f)
     except FileNotFoundError:
         product_info = {"name": "BestApp", "description": "Best AI BI tool."}
-        save_product_info(product_info)
+        write_product_info(product_info)
     return product_info
 
-def save_product_info(product_info):
+def write_product_info(product_info):
     with open(f"{DEFAULT_ROOT_FOLDER}/product_info.json", "w") as f:
         json.dump(product_info, f)
 
+def save_product_info(product_info):
+    write_product_info(product_info)
+    load_product_info.clear()
+
 if __name__ == "__main__":
 
     # Create the "DEFAULT_ROOT_FOLDER" folder if it doesn't exist
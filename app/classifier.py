@@ -1,7 +1,13 @@
 import json
+import logging
 from enum import Enum
 
 from llm import LLMModel
+from llm_metrics import BudgetExceeded
+from tokens import count_tokens
+
+
+logger = logging.getLogger(__name__)
 
 
 SYS_PROMPT = """As a Content Classifier, your task is to classify the given text into one of 
@@ -20,6 +26,23 @@ SYS_PROMPT = """As a Content Classifier, your task is to classify the given text
     """
 
 
+BATCH_SYS_PROMPT = """As a Content Classifier, your task is to classify each of the given pages into one of 
+    the predefined content types. The available content types are:
+
+    {content_types}. 
+
+    Every page starts with a line "### id: <id>" followed by its text. Read each page carefully 
+    and determine the most appropriate content type based on the information provided. 
+    Output ONLY a JSON array with one object per page, with the keys "id" and "content_type" 
+    and the corresponding normalized value. Do not include any explanations or additional text. Exmaple output:
+
+    ```json
+    [{{"id": "0", "content_type": "<product_description|service_description|blog_post|...|others>"}}, 
+     {{"id": "1", "content_type": "<product_description|service_description|blog_post|...|others>"}}]
+    ````
+    """
+
+
 class ContentTypes(str, Enum):
     product = "product_description"
     service = "service_description"
@@ -42,11 +65,12 @@ class ContentClassifier:
         
         content_types = [content_type.value for content_type in ContentTypes if content_type not in self.exclude_types]
         self.sys_prompt = SYS_PROMPT.format(content_types=", ".join(content_types))
+        self.batch_sys_prompt = BATCH_SYS_PROMPT.format(content_types=", ".join(content_types))
         self.llm_model = llm_model
   
     def classify(self, content: str) -> ContentTypes:
         response = self.llm_model.chat(content, self.sys_prompt, 
-                                       64, 0.) 
+                                       64, 0., tag="classifier") 
 
         res = response.choices[0].message.content
         # Remove the newline character and the end-of-text identifier
@@ -54,4 +78,75 @@ class ContentClassifier:
 
         # Parse the JSON string
         res_dict = json.loads(res)
-        return ContentTypes(res_dict['content_type'])
\ No newline at end of file
+        return ContentTypes(res_dict['content_type'])
+
+    def classify_many(self, contents: list[str]) -> list[ContentTypes]:
+        # Classify several pages concurrently, the results keep the order of the pages
+        return self.llm_model.map(self.classify, contents)
+
+    def make_batches(self, contents, max_batch_size=8, page_tokens=500, batch_tokens=4000):
+        # Pack truncated pages into batches that fit the prompt token budget
+        batches, batch, num_tokens = [], [], 0
+        for idx, content in enumerate(contents):
+            # Truncate the page to its token share (about 4 characters per token)
+            page = content[:page_tokens * 4]
+            page_len = count_tokens(page)
+            if batch and (len(batch) >= max_batch_size or num_tokens + page_len > batch_tokens):
+                batches.append(batch)
+                batch, num_tokens = [], 0
+            batch.append((idx, page))
+            num_tokens += page_len
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def parse_batch(self, res):
+        # Returns {id: ContentTypes} for every entry that could be parsed
+        idx_start = res.find('[')
+        idx_end = res.rfind(']')
+        try:
+            entries = json.loads(res[idx_start:idx_end + 1])
+        except json.JSONDecodeError:
+            return {}
+
+        labels = {}
+        for entry in entries if isinstance(entries, list) else []:
+            try:
+                labels[str(entry['id'])] = ContentTypes(entry['content_type'])
+            except (KeyError, TypeError, ValueError):
+                continue
+        return labels
+
+    def classify_pages(self, batch) -> dict:
+        # A failing batch call returns no labels, its pages are then classified one by one
+        prompt = "\n\n".join(f"### id: {idx}\n{page}" for idx, page in batch)
+        try:
+            response = self.llm_model.chat(prompt, self.batch_sys_prompt,
+                                           24 * len(batch) + 32, 0., tag="classifier")
+        except BudgetExceeded:
+            raise
+        except Exception as ex:
+            logger.warning(f"Batch classification of {len(batch)} pages failed ({type(ex).__name__}: {ex}).")
+            return {}
+
+        res = response.choices[0].message.content or ""
+        # Remove the newline character and the end-of-text identifier
+        res = res.strip().replace("<|eot_id|>", "")
+        labels = self.parse_batch(res)
+        return {idx: labels[str(idx)] for idx, _ in batch if str(idx) in labels}
+
+    def classify_batch(self, contents: list[str], max_batch_size=8,
+                       page_tokens=500, batch_tokens=4000) -> list[ContentTypes]:
+        # Classify several pages per LLM call, the batches run concurrently
+        batches = self.make_batches(contents, max_batch_size, page_tokens, batch_tokens)
+        labels = {}
+        for batch_labels in self.llm_model.map(self.classify_pages, batches):
+            labels.update(batch_labels)
+
+        # Pages missing from the answers are classified one by one
+        missing = [idx for idx in range(len(contents)) if idx not in labels]
+        if missing:
+            logger.warning(f"Batch classification missed {len(missing)} of {len(contents)} pages, classifying them separately.")
+            for idx, cls in zip(missing, self.classify_many([contents[idx] for idx in missing])):
+                labels[idx] = cls
+        return [labels[idx] for idx in range(len(contents))]
\ No newline at end of file
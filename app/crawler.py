@@ -1,102 +1,403 @@
+import os
+import time
 import logging
 import json
+import asyncio
+import threading
+import contextvars
 import requests
-from urllib.parse import urlparse, urljoin
+from requests.adapters import HTTPAdapter
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
-from langdetect import detect
-from bs4 import BeautifulSoup
+from page_parser import parse_html
+from http_cache import HttpCache
+from frontier import Frontier
+from langfilter import LanguageFilter
+from sitemap import url_priority, read_robots, read_sitemaps
 
 
 logger = logging.getLogger(__name__)
 
+# Start URLs are crawled before any sitemap or discovered page
+START_PRIORITY = 100.
+
+
+def read_pages(path):
+    # Yield the crawled pages one at a time, from a JSONL or a JSON file
+    if not path.endswith('.jsonl'):
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from json.load(f)
+        return
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of an interrupted crawl may be incomplete
+                logger.warning(f"Skipping incomplete line in '{path}'.")
+
 
 class BeautifulSoupCrawler:
     def __init__(self, name, allowed_domains, start_urls,
-                 max_pages=10, languages=['en'], out_file="crawl_res.json"):
+                 max_pages=10, languages=['en'], out_file="crawl_res.json",
+                 parser='html.parser', timeout=30, pool_size=10,
+                 cache_dir=None, cache_max_mb=512,
+                 seen_set='set', seen_capacity=1_000_000, prioritize=False, max_queue_size=None,
+                 lang_sample_size=2000, lang_hints=True,
+                 robots=False, sitemaps=False, max_sitemap_urls=5000, on_item=None):
         self.name = name
         self.allowed_domains = allowed_domains
         self.start_urls = start_urls
         self.languages = languages
         self.out_file = out_file
         self.max_pages = max_pages
+        self.parser = parser
+        self.timeout = timeout
         self.data = []
         self.counter = 0
 
+        # One pooled session for all requests, so connections are kept alive
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Optional persistent HTTP cache shared between runs
+        self.cache = HttpCache(cache_dir, cache_max_mb) if cache_dir else None
+
+        self.seen_set = seen_set
+        self.seen_capacity = seen_capacity
+        self.prioritize = prioritize
+        self.max_queue_size = max_queue_size
+
+        self.language_filter = LanguageFilter(languages, sample_size=lang_sample_size, use_hints=lang_hints)
+
+        # robots.txt rules and crawl-delay per host, read on first use
+        self.use_robots = robots
+        self.use_sitemaps = sitemaps
+        self.max_sitemap_urls = max_sitemap_urls
+        self.user_agent = self.session.headers.get('User-Agent', '*')
+        self.robots = {}
+        self.next_fetch_at = {}
+        self.robots_lock = threading.Lock()
+        # robots.txt is downloaded under the lock of its host, fetches from other hosts go on
+        self.host_locks = defaultdict(threading.Lock)
+
+        # Requests, bytes and seconds spent per stage, see `timed`
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+
+        # A .jsonl output file is written page by page and lets an interrupted crawl resume
+        self.streaming = out_file.endswith('.jsonl')
+        self.out = None
+        self.crawled_urls = []
+        self.resume_links = []
+        # Called with every saved page (without its links), also with the pages of a resumed crawl
+        self.on_item = on_item
+
     def is_valid_url(self, url):
         # Check if the URL belongs to the allowed domains
         parsed_url = urlparse(url)
         return any(parsed_url.netloc.endswith(domain) for domain in self.allowed_domains)
 
-    def extract_links(self, url):
-        # Send a GET request to the URL
-        response = requests.get(url)
-        # Create a BeautifulSoup object from the response content
-        soup = BeautifulSoup(response.content, 'html.parser')
-        # Extract all the links from the page
-        links = [urljoin(url, link.get('href')) for link in soup.find_all('a', href=True)]
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stat(f"{stage}_sec", time.perf_counter() - start)
+
+    def add_stat(self, key, value=1):
+        with self.stats_lock:
+            self.stats[key] += value
+
+    def robots_for(self, url):
+        host = urlparse(url).netloc
+        robots = self.robots.get(host)
+        if robots is not None:
+            return robots
+        with self.robots_lock:
+            host_lock = self.host_locks[host]
+        with host_lock:
+            if host not in self.robots:
+                self.robots[host] = read_robots(self.session, url, self.timeout)
+            return self.robots[host]
+
+    def is_allowed(self, url):
+        return not self.use_robots or self.robots_for(url).can_fetch(self.user_agent, url)
+
+    def throttle(self, url):
+        # Honor the crawl-delay of the host, also across the threads of the async crawler
+        if not self.use_robots:
+            return
+        delay = self.robots_for(url).crawl_delay(self.user_agent)
+        if not delay:
+            return
+        host = urlparse(url).netloc
+        with self.robots_lock:
+            now = time.monotonic()
+            fetch_at = max(now, self.next_fetch_at.get(host, 0.))
+            self.next_fetch_at[host] = fetch_at + float(delay)
+        if fetch_at > now:
+            time.sleep(fetch_at - now)
+
+    def fetch(self, url):
+        self.throttle(url)
+
+        # Revalidate a cached copy of the page instead of downloading it again
+        cached = self.cache.get(url) if self.cache else None
+        headers = self.cache.conditional_headers(cached) if cached else {}
+
+        # Send a GET request to the URL over the pooled session
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        self.add_stat('requests')
+        self.add_stat('bytes_fetched', len(response.content))
+
+        if cached and response.status_code == 304:
+            self.cache.touch(url)
+            return cached['content']
+        if self.cache:
+            self.cache.store(url, response)
+        return response.content
+
+    def parse(self, content):
+        return parse_html(content, self.parser)
+
+    def extract_links(self, url, doc=None):
+        if doc is None:
+            doc = self.parse(self.fetch(url))
+        # Extract all the links from the page, without alternates in other languages
+        skipped = {link for link, hreflang in doc.get_alternates(url)
+                   if not self.language_filter.accept_hreflang(hreflang)}
+        links = [link for link in doc.get_links(url) if link not in skipped]
         # Filter the links to keep only the valid ones
-        valid_links = [link for link in links if self.is_valid_url(link)]
+        valid_links = [link for link in links if self.is_valid_url(link) and self.language_filter.accept_url(link)
+                       and self.is_allowed(link)]
         return valid_links
 
-    def extract_text(self, url):
-        # Send a GET request to the URL
-        response = requests.get(url)
-        # Create a BeautifulSoup object from the response content
-        soup = BeautifulSoup(response.content, 'html.parser')
+    def extract_text(self, url, doc=None):
+        if doc is None:
+            doc = self.parse(self.fetch(url))
+        return doc.get_text()
+
+    def create_frontier(self):
+        prioritized = self.prioritize or self.use_sitemaps
+        frontier = Frontier(seen=self.seen_set, capacity=self.seen_capacity,
+                            priority=url_priority if prioritized else None,
+                            max_size=self.max_queue_size)
+        # Pages of a resumed crawl are not fetched again, but their links are queued
+        for url in self.crawled_urls:
+            frontier.mark_seen(url)
+        for url in self.start_urls:
+            frontier.push(url, priority=START_PRIORITY)
+        if self.use_sitemaps:
+            self.seed_from_sitemaps(frontier)
+        frontier.extend(self.resume_links)
+        return frontier
 
-        try: 
-            # Find the main content container
-            main_content = soup.find("div", class_="main-content")  # Adjust the class name according to the website's structure
+    def seed_from_sitemaps(self, frontier):
+        # Sitemaps listed in robots.txt, or the default location of each start host
+        sitemap_urls = []
+        for url in self.start_urls:
+            parsed_url = urlparse(url)
+            sitemap_urls.extend(self.robots_for(url).site_maps()
+                                or [f"{parsed_url.scheme}://{parsed_url.netloc}/sitemap.xml"])
+        sitemap_urls = list(dict.fromkeys(sitemap_urls))
 
-            # Extract the text content from the main content container
-            text_content = main_content.get_text(strip=True)
-        except Exception as ex:
-            # Extract the text content of the page, excluding <style> and <script> tags
-            text_content = ' '.join([element.get_text(strip=True) for element in soup.find_all(string=True) if element.parent.name not in ['style', 'script']])
-        return text_content
+        pages = read_sitemaps(self.session, sitemap_urls, self.timeout, self.max_sitemap_urls)
+        num_added = 0
+        for url, lastmod in pages:
+            if self.is_valid_url(url) and self.language_filter.accept_url(url) and self.is_allowed(url):
+                num_added += frontier.push(url, priority=url_priority(url, lastmod))
+        logger.info(f"Seeded crawler '{self.name}' with {num_added} pages from {len(sitemap_urls)} sitemaps.")
+
+    def resume(self):
+        # Continue from the pages already written to the output file
+        for item in read_pages(self.out_file):
+            self.crawled_urls.append(item['url'])
+            self.resume_links.extend(item.pop('links', []))
+            if self.on_item:
+                self.on_item(dict(item))
+        self.counter = len(self.crawled_urls)
+        if self.counter:
+            logger.info(f"Resuming crawler '{self.name}' with {self.counter} pages from '{self.out_file}'.")
+
+    def save_item(self, item, links):
+        if not self.streaming:
+            self.data.append(item)
+        else:
+            # Write the page right away, the links are kept to resume the crawl
+            self.out.write(json.dumps({**item, 'links': links}, ensure_ascii=False) + '\n')
+            self.out.flush()
+        if self.on_item:
+            self.on_item(dict(item))
+
+    def process_page(self, url):
+        # Returns the parsed item and the outgoing links, or None if the page is skipped.
+        # The page is fetched and parsed once, text and links come from the same document.
+        lang_filter = self.language_filter
+        if not lang_filter.accept_url(url) or not self.is_allowed(url):
+            return None
+        with self.timed('fetch'):
+            content = self.fetch(url)
+        with self.timed('parse'):
+            doc = self.parse(content)
+
+        # The <html lang> hint decides before any text is extracted
+        lang = lang_filter.detect_hint(doc)
+        if lang is not None:
+            lang_filter.record(url, lang)
+            if not lang_filter.accept(lang, 'hint'):
+                return None
+
+        with self.timed('text'):
+            text_content = self.extract_text(url, doc)
+
+        if lang is None:
+            with self.timed('langdetect'):
+                lang = lang_filter.detect_text(text_content)
+            lang_filter.record(url, lang)
+            if not lang_filter.accept(lang, 'text'):
+                return None
+
+        item = {
+            'url': url,
+            'title': doc.get_title(),
+            'headings': doc.get_headings(),
+            'text_content': text_content
+        }
+
+        with self.timed('links'):
+            links = self.extract_links(url, doc)
+        return item, links
 
     def crawl(self):
-        visited_urls = set()
-        queue = self.start_urls.copy()
+        # URLs are deduplicated when they enter the frontier, every popped URL is new
+        frontier = self.create_frontier()
 
-        while queue:
-            url = queue.pop(0)
+        while frontier:
+            url = frontier.pop()
 
             if self.counter >= self.max_pages:
                 break
 
-            if url in visited_urls:
+            # A slow or unreachable page is skipped, the crawl goes on
+            try:
+                res = self.process_page(url)
+            except requests.RequestException as ex:
+                logger.warning(f"Failed to crawl URL {url}: {ex}")
                 continue
-
-            visited_urls.add(url)
-
-            text_content = self.extract_text(url)
-
-            if detect(text_content) not in self.languages:
+            if res is None:
                 continue
-
-            item = {
-                'url': url,
-                'text_content': text_content
-            }
+            item, links = res
 
             logger.info(f"Parsed item from URL: {url}")
 
-            self.data.append(item)
-
-            links = self.extract_links(url)
-            queue.extend(links)
+            self.save_item(item, links)
+            frontier.extend(links)
 
             self.counter +=1
 
     def start(self):
         logger.info(f"Running competitor analysis for '{self.name}'.")
 
-        self.crawl()
+        if self.streaming:
+            if os.path.exists(self.out_file):
+                self.resume()
+            self.out = open(self.out_file, 'a', encoding='utf-8')
+            # Don't append to an incomplete last line
+            if self.out.tell() > 0:
+                with open(self.out_file, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self.out.write('\n')
+
+        try:
+            self.crawl()
+        finally:
+            self.session.close()
+            if self.out:
+                self.out.close()
+            self.language_filter.log_stats(self.name)
+            logger.debug(f"Crawler '{self.name}' stats: {dict(self.stats)}")
+            if self.cache:
+                stats = self.cache.stats()
+                logger.info(f"HTTP cache: {stats['hits']} hits, {stats['misses']} misses "
+                            f"(hit rate {stats['hit_rate']:.0%}), {stats['size_mb']:.1f} MB stored.")
+                self.cache.close()
 
-        # Save the extracted data to a JSON file
-        with open(self.out_file, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=4)
+        if not self.streaming:
+            # Save the extracted data to a JSON file
+            with open(self.out_file, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f, ensure_ascii=False, indent=4)
 
-        logger.info(f"Crawler '{self.name}' completed. Extracted {len(self.data)} items.")
+        logger.info(f"Crawler '{self.name}' completed. Extracted {self.counter} items.")
 
+
+# Pages are scheduled by an asyncio loop while the blocking fetch and parse of
+# a page runs on a thread pool. `concurrency` caps the number of pages in flight
+# and `per_domain_concurrency` the number of pages in flight per domain.
+class AsyncBeautifulSoupCrawler(BeautifulSoupCrawler):
+    def __init__(self, name, allowed_domains, start_urls,
+                 max_pages=10, languages=['en'], out_file="crawl_res.json",
+                 concurrency=8, per_domain_concurrency=2, **kwargs):
+        # Size the connection pool to the number of pages in flight
+        kwargs.setdefault('pool_size', max(concurrency, 10))
+        super().__init__(name, allowed_domains, start_urls, max_pages=max_pages,
+                         languages=languages, out_file=out_file, **kwargs)
+        self.concurrency = max(1, concurrency)
+        self.per_domain_concurrency = max(1, per_domain_concurrency)
+
+    async def _process_page(self, url, executor, domain_limits):
+        domain = urlparse(url).netloc
+        async with domain_limits[domain]:
+            loop = asyncio.get_running_loop()
+            # Run in the caller's context, so context variables (e.g. for logging) are kept
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(executor, ctx.run, self.process_page, url)
+
+    async def _crawl(self):
+        frontier = self.create_frontier()
+        pending = set()
+        domain_limits = defaultdict(lambda: asyncio.Semaphore(self.per_domain_concurrency))
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while frontier or pending:
+                # Keep at most `concurrency` pages in flight and never more
+                # than the remaining page budget
+                while frontier and len(pending) < min(self.concurrency, self.max_pages - self.counter):
+                    url = frontier.pop()
+                    task = asyncio.create_task(self._process_page(url, executor, domain_limits))
+                    task.url = url
+                    pending.add(task)
+
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        res = task.result()
+                    except Exception as ex:
+                        logger.warning(f"Failed to crawl URL {task.url}: {ex}")
+                        continue
+                    if res is None or self.counter >= self.max_pages:
+                        continue
+                    item, links = res
+
+                    logger.info(f"Parsed item from URL: {task.url}")
+
+                    self.save_item(item, links)
+                    frontier.extend(links)
+
+                    self.counter += 1
+
+    def crawl(self):
+        asyncio.run(self._crawl())
@@ -0,0 +1,80 @@
+import re
+import hashlib
+
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+NUM_BITS = 64
+
+
+def simhash(text, shingle_size=3):
+    # 64-bit SimHash over word shingles, similar texts get fingerprints with few differing bits.
+    # Texts without words have no fingerprint (None), they are not similar to anything.
+    words = TOKEN_PATTERN.findall(text.lower())
+    if not words:
+        return None
+    # numpy is only imported once deduplication is used
+    import numpy as np
+    shingles = {' '.join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+
+    hashes = np.array([int.from_bytes(hashlib.blake2b(sh.encode('utf-8'), digest_size=8).digest(), 'little')
+                       for sh in shingles], dtype=np.uint64)
+    # One row of bits per shingle, each bit votes +1 or -1
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(hashes)
+
+    fingerprint = 0
+    for i in np.flatnonzero(votes > 0):
+        fingerprint |= 1 << int(i)
+    return fingerprint
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+# Groups near-duplicate pages. Two pages are near-duplicates when their SimHash
+# fingerprints agree on at least `threshold` of the bits. The fingerprints are
+# split into `max_distance + 1` bands; by the pigeonhole principle two
+# near-duplicates share at least one band exactly, so only pages sharing a band
+# are compared.
+class NearDuplicateDetector:
+    def __init__(self, threshold=0.9, shingle_size=3) -> None:
+        self.max_distance = int((1. - threshold) * NUM_BITS)
+        self.shingle_size = shingle_size
+
+        num_bands = min(self.max_distance + 1, NUM_BITS)
+        band_size = -(-NUM_BITS // num_bands)
+        self.bands = [(start, (1 << min(band_size, NUM_BITS - start)) - 1)
+                      for start in range(0, NUM_BITS, band_size)]
+        self.index = {}
+        self.fingerprints = {}
+
+    def _band_keys(self, fingerprint):
+        return [(i, (fingerprint >> start) & mask) for i, (start, mask) in enumerate(self.bands)]
+
+    def find(self, fingerprint):
+        best, best_distance = None, self.max_distance + 1
+        for band_key in self._band_keys(fingerprint):
+            for key in self.index.get(band_key, []):
+                distance = hamming_distance(fingerprint, self.fingerprints[key])
+                if distance < best_distance:
+                    best, best_distance = key, distance
+        return best
+
+    def add(self, key, fingerprint):
+        self.fingerprints[key] = fingerprint
+        for band_key in self._band_keys(fingerprint):
+            self.index.setdefault(band_key, []).append(key)
+
+    def find_or_add(self, key, text):
+        # Returns the key of the representative page if the text is a near-duplicate,
+        # otherwise the page becomes a new representative and None is returned. Pages
+        # without text (e.g. image-only pages) are never grouped.
+        fingerprint = simhash(text, self.shingle_size)
+        if fingerprint is None:
+            return None
+        representative = self.find(fingerprint)
+        if representative is None:
+            self.add(key, fingerprint)
+        return representative
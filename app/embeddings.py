@@ -0,0 +1,398 @@
+import os
+import glob
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+from llm import RateLimiter, retryable_errors
+from llm_metrics import LLMMetrics
+from tokens import count_tokens, truncate_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def normalize(vectors):
+    # Unit length, so the dot product is the cosine similarity
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# Embeddings from an OpenAI compatible `/embeddings` endpoint. Texts are sent in
+# batches of `batch_size`, with the retries and rate limits of `LLMModel`.
+class OpenAIEmbedder:
+    def __init__(self, url: str, api_key: str, model_name: str, batch_size: int = 64,
+                 max_tokens: int = 8000, requests_per_min: int | None = None,
+                 tokens_per_min: int | None = None, max_retries: int = 5, timeout: float = 60.,
+                 metrics: LLMMetrics | None = None) -> None:
+        import openai
+        self.model_name = model_name
+        self.batch_size = batch_size
+        # Longer texts are cut, the endpoint rejects them otherwise
+        self.max_tokens = max_tokens
+        self.max_retries = max_retries
+        self.retryable_errors = retryable_errors()
+        self.openai_client = openai.OpenAI(base_url=url, api_key=api_key, timeout=timeout, max_retries=0)
+        self.rate_limiter = RateLimiter(requests_per_min, tokens_per_min)
+        self.metrics = metrics or LLMMetrics()
+
+    def embed(self, texts) -> np.ndarray:
+        texts = [truncate_tokens(text, self.max_tokens) or " " for text in texts]
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed_batch(texts[i:i + self.batch_size]))
+        return normalize(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+    def _embed_batch(self, batch):
+        start = time.perf_counter()
+        tokens = sum(count_tokens(text) for text in batch)
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(tokens)
+            try:
+                response = self.openai_client.embeddings.create(model=self.model_name, input=batch)
+                break
+            except self.retryable_errors as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Embedding request failed after {attempt + 1} attempts: {e}")
+                    self.metrics.record('embedding', self.model_name, latency=time.perf_counter() - start,
+                                        retries=attempt, error=True)
+                    raise
+                delay = min(60., 2 ** attempt) * (0.5 + random.random())
+                logger.warning(f"Embedding request failed ({type(e).__name__}), retrying in {delay:.1f}s.")
+                time.sleep(delay)
+        usage = getattr(response, 'usage', None)
+        self.metrics.record('embedding', self.model_name,
+                            prompt_tokens=usage.prompt_tokens if usage else tokens,
+                            latency=time.perf_counter() - start, retries=attempt)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+# Embeddings computed locally with sentence-transformers (optional dependency)
+class LocalEmbedder:
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', batch_size: int = 64, device: str | None = None) -> None:
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("Local embeddings need sentence-transformers: pip install sentence-transformers")
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = SentenceTransformer(model_name, device=device)
+
+    def embed(self, texts) -> np.ndarray:
+        vectors = self.model.encode(list(texts), batch_size=self.batch_size, convert_to_numpy=True)
+        return normalize(vectors)
+
+
+def create_embedder(settings):
+    # `settings` are the embedder arguments plus `provider` ("openai" or "local")
+    settings = dict(settings)
+    provider = settings.pop('provider', 'openai')
+    if provider == 'local':
+        for key in ('url', 'api_key', 'max_tokens', 'requests_per_min', 'tokens_per_min',
+                    'max_retries', 'timeout', 'metrics'):
+            settings.pop(key, None)
+        return LocalEmbedder(**settings)
+    if provider == 'openai':
+        return OpenAIEmbedder(**settings)
+    raise ValueError(f"Unknown embedding provider: {provider}")
+
+
+@contextmanager
+def file_lock(path, timeout=120., stale_after=900.):
+    # Lock shared by processes: the lock file is created exclusively. A lock file
+    # older than `stale_after` seconds is left over from a crashed process.
+    start = time.monotonic()
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > stale_after:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() - start > timeout:
+                raise TimeoutError(f"Could not lock '{path}' within {timeout:.0f}s.")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+
+# Embeddings of page summaries of all competitors and runs, stored in `folder`
+# as one float16 matrix (`vectors.npy`) and one JSON line of metadata per row
+# (`meta.jsonl`). A summary is embedded once: rows are keyed on competitor, URL
+# and summary text, a later run with the same summary only updates `last_run`.
+# Search loads the matrix as float32 and ranks all rows with one product.
+# Several processes (e.g. `main.py` and the app) can share the folder: the files
+# are read and written under a lock file, `save` merges the rows saved by the
+# others first, and searches pick them up once `index.json` changes.
+class EmbeddingIndex:
+    def __init__(self, folder) -> None:
+        self.folder = folder
+        self.vectors_file = os.path.join(folder, 'vectors.npy')
+        self.meta_file = os.path.join(folder, 'meta.jsonl')
+        self.info_file = os.path.join(folder, 'index.json')
+        self.lock_file = os.path.join(folder, 'index.lock')
+        self.lock = threading.Lock()
+        self.model_name = None
+        self.meta = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.keys = {}
+        # (mtime, size) of `index.json` when the files were last read or written
+        self.loaded_state = None
+
+        with self.lock:
+            self._merge_saved()
+        if self.meta:
+            logger.info(f"Loaded {len(self.meta)} embeddings ({self.model_name}) from '{folder}'.")
+
+    def __len__(self):
+        return len(self.meta)
+
+    def _saved_state(self):
+        try:
+            stat = os.stat(self.info_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _merge_saved(self, locked=False):
+        # Merges the rows saved since the last read into memory, holding `self.lock`
+        # (and the lock file if `locked`)
+        state = self._saved_state()
+        if state is None or state == self.loaded_state:
+            return
+        with nullcontext() if locked else file_lock(self.lock_file):
+            with open(self.info_file, 'r', encoding='utf-8') as f:
+                model_name = json.load(f)['model_name']
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                meta = [json.loads(line) for line in f if line.strip()]
+            vectors = np.load(self.vectors_file).astype(np.float32)
+            self.loaded_state = self._saved_state()
+        if len(vectors) != len(meta):
+            raise ValueError(f"Embedding index '{self.folder}' is inconsistent: "
+                             f"{len(vectors)} vectors, {len(meta)} entries.")
+        if self.model_name not in (None, model_name):
+            raise ValueError(f"Embedding index '{self.folder}' was saved with embeddings of '{model_name}', "
+                             f"not '{self.model_name}'.")
+        self.model_name = model_name
+
+        new_rows = []
+        for i, entry in enumerate(meta):
+            row = self.keys.get(entry['key'])
+            if row is None:
+                new_rows.append(i)
+                self.keys[entry['key']] = len(self.meta)
+                self.meta.append(entry)
+            else:
+                own = self.meta[row]
+                own['last_run'] = max(filter(None, (own['last_run'], entry['last_run'])), default=None)
+        if new_rows:
+            self.vectors = vectors[new_rows] if len(self.meta) == len(new_rows) else \
+                np.vstack([self.vectors, vectors[new_rows]])
+
+    def refresh(self):
+        # Picks up the rows saved by other processes
+        with self.lock:
+            self._merge_saved()
+
+    @staticmethod
+    def make_key(competitor, url, text):
+        return text_hash(json.dumps([competitor, url, text], ensure_ascii=False))
+
+    def add(self, embedder, entries, run=None):
+        # `entries` are dicts with `competitor`, `url` and `text`, other fields are kept as metadata.
+        # Returns the number of new rows, only their texts are embedded.
+        self.refresh()
+        if self.model_name not in (None, embedder.model_name):
+            raise ValueError(f"Embedding index '{self.folder}' holds embeddings of '{self.model_name}', "
+                             f"not '{embedder.model_name}'; use another folder or delete it to rebuild.")
+        new_entries, seen = [], set()
+        with self.lock:
+            for entry in entries:
+                key = self.make_key(entry['competitor'], entry['url'], entry['text'])
+                if key in self.keys:
+                    entry = self.meta[self.keys[key]]
+                    entry['last_run'] = max(filter(None, (entry['last_run'], run)), default=None)
+                elif key not in seen:
+                    seen.add(key)
+                    new_entries.append({**entry, 'key': key, 'run': run, 'last_run': run})
+        if not new_entries:
+            return 0
+
+        # The endpoint is called outside the lock, other competitors can be added meanwhile
+        vectors = embedder.embed([entry['text'] for entry in new_entries])
+        with self.lock:
+            # Entries added by another caller meanwhile are dropped
+            keep = [i for i, entry in enumerate(new_entries) if entry['key'] not in self.keys]
+            vectors = vectors[keep]
+            new_entries = [new_entries[i] for i in keep]
+            if len(self.meta) == 0:
+                self.vectors = vectors
+            else:
+                self.vectors = np.vstack([self.vectors, vectors])
+            for entry in new_entries:
+                self.keys[entry['key']] = len(self.meta)
+                self.meta.append(entry)
+            self.model_name = embedder.model_name
+        return len(new_entries)
+
+    def save(self):
+        # The rows saved by other processes are merged first, so none are lost. Written
+        # to temporary files first, a crash never leaves a half written index.
+        os.makedirs(self.folder, exist_ok=True)
+        with self.lock, file_lock(self.lock_file):
+            self._merge_saved(locked=True)
+            with open(self.vectors_file + '.tmp', 'wb') as f:
+                np.save(f, self.vectors.astype(np.float16))
+            with open(self.meta_file + '.tmp', 'w', encoding='utf-8') as f:
+                for entry in self.meta:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            with open(self.info_file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'model_name': self.model_name, 'dim': int(self.vectors.shape[1]) if len(self.meta) else 0,
+                           'size': len(self.meta)}, f)
+            for path in (self.vectors_file, self.meta_file, self.info_file):
+                os.replace(path + '.tmp', path)
+            self.loaded_state = self._saved_state()
+
+    def _mask(self, competitors=None, classes=None, latest_only=False):
+        mask = np.ones(len(self.meta), dtype=bool)
+        if competitors:
+            mask &= np.array([entry['competitor'] in competitors for entry in self.meta], dtype=bool)
+        if classes:
+            mask &= np.array([entry.get('class') in classes for entry in self.meta], dtype=bool)
+        if latest_only:
+            # Only the summaries still present in the latest run of their competitor
+            latest = {}
+            for entry in self.meta:
+                if entry['last_run'] is not None:
+                    latest[entry['competitor']] = max(latest.get(entry['competitor'], ''), entry['last_run'])
+            mask &= np.array([entry['last_run'] == latest.get(entry['competitor']) for entry in self.meta], dtype=bool)
+        return mask
+
+    def search(self, query_vector, k=10, competitors=None, classes=None, latest_only=False):
+        # The `k` rows most similar to the (normalized) query vector, best first
+        with self.lock:
+            self._merge_saved()
+            if not self.meta:
+                return []
+            scores = self.vectors @ np.asarray(query_vector, dtype=np.float32).reshape(-1)
+            mask = self._mask(competitors, classes, latest_only)
+            scores = np.where(mask, scores, -np.inf)
+            k = min(k, int(mask.sum()))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [{**self.meta[i], 'score': float(scores[i])} for i in top]
+
+    def query(self, embedder, text, k=10, **filters):
+        return self.search(embedder.embed([text])[0], k, **filters)
+
+    def duplicates(self, threshold=0.95, competitors=None, block_size=1024):
+        # Pairs of rows of different URLs at least `threshold` similar, e.g. the same
+        # text on the sites of two competitors. Compared block by block to bound the memory.
+        with self.lock:
+            self._merge_saved()
+            rows = np.flatnonzero(self._mask(competitors))
+            vectors = self.vectors[rows]
+            pairs = []
+            for start in range(0, len(rows), block_size):
+                scores = vectors[start:start + block_size] @ vectors.T
+                for i, j in zip(*np.nonzero(scores >= threshold)):
+                    a, b = rows[start + i], rows[j]
+                    if a < b and self.meta[a]['url'] != self.meta[b]['url']:
+                        pairs.append((self.meta[a], self.meta[b], float(scores[i, j])))
+        return sorted(pairs, key=lambda pair: -pair[2])
+
+
+def read_summaries(folder, name):
+    # Entries of the page summaries and the total summary of a competitor folder
+    with open(os.path.join(folder, f'summaries_{name}.json'), 'r', encoding='utf-8') as f:
+        summaries = json.load(f)
+    entries = []
+    for item in summaries:
+        if 'total_summary' in item:
+            if item['total_summary']:
+                entries.append({'competitor': name, 'url': '', 'title': f"{name} (total summary)",
+                                'class': 'total_summary', 'text': item['total_summary']})
+        elif item.get('summary') and 'duplicate_of' not in item:
+            entries.append({'competitor': name, 'url': item['url'], 'title': item.get('title', ''),
+                            'class': item.get('class'), 'text': item['summary']})
+    return entries
+
+
+def run_of(folder, name):
+    # The start time (YYYYmmdd_HHMMSS) of the run of a competitor folder: runs of `main.py`
+    # are <root>/competitor_analyze_<time>/<name>, those of the app <root>/<name>/<time>_<job id>
+    if os.path.basename(folder) == name:
+        return os.path.basename(os.path.dirname(os.path.abspath(folder)))[len('competitor_analyze_'):]
+    return os.path.basename(folder)[:len('YYYYmmdd_HHMMSS')]
+
+
+def index_folder(index, embedder, folder, name):
+    # Adds the summaries of a competitor folder, unchanged summaries are not embedded again
+    num_new = index.add(embedder, read_summaries(folder, name), run=run_of(folder, name))
+    logger.info(f"Embedded {num_new} new summaries of '{name}', the index holds {len(index)}.")
+    return num_new
+
+
+def find_folders(root_folder):
+    # (competitor folder, name) of the analyses under a root folder, oldest run first
+    folders = []
+    for summary_file in glob.glob(os.path.join(root_folder, '*', '*', 'summaries_*.json')):
+        folder = os.path.dirname(summary_file)
+        name = os.path.basename(summary_file)[len('summaries_'):-len('.json')]
+        folders.append((run_of(folder, name), folder, name))
+    return [(folder, name) for _, folder, name in sorted(folders)]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Embed page summaries and search them')
+    parser.add_argument('--index', type=str, default='results/embeddings',
+                        help='Folder of the embedding index (default: results/embeddings)')
+    parser.add_argument('--provider', type=str, default='openai', choices=['openai', 'local'])
+    parser.add_argument('--model', type=str, default='text-embedding-3-small')
+    commands = parser.add_subparsers(dest='command', required=True)
+    builder = commands.add_parser('build', help='Embed the summaries of all runs under a root folder')
+    builder.add_argument('root_folder')
+    searcher = commands.add_parser('search', help='Summaries most similar to a query')
+    searcher.add_argument('query')
+    searcher.add_argument('-k', type=int, default=10)
+    searcher.add_argument('--competitor', action='append', default=None)
+    searcher.add_argument('--latest', action='store_true', help='Only summaries of the latest run of each competitor')
+    args = parser.parse_args()
+
+    settings = {'provider': args.provider, 'model_name': args.model}
+    if args.provider == 'openai':
+        from dotenv import load_dotenv
+        load_dotenv()
+        settings.update(url=os.environ['URL'], api_key=os.environ['API_KEY'])
+    embedder = create_embedder(settings)
+    index = EmbeddingIndex(args.index)
+    if args.command == 'build':
+        for folder, name in find_folders(args.root_folder):
+            index_folder(index, embedder, folder, name)
+        index.save()
+    else:
+        for hit in index.query(embedder, args.query, k=args.k, competitors=args.competitor, latest_only=args.latest):
+            print(f"{hit['score']:.3f}  {hit['competitor']:<20} {hit['url'] or '(total summary)'}")
+            print(f"       {hit['text'][:200]}")
@@ -0,0 +1,131 @@
+import re
+import math
+import heapq
+import hashlib
+import itertools
+from collections import deque
+from urllib.parse import urlsplit, urlunsplit, urldefrag, parse_qsl, urlencode
+
+
+# Query parameters that only track the visitor and don't change the page
+TRACKING_PARAMS = {'gclid', 'fbclid', 'msclkid', 'dclid', 'mc_cid', 'mc_eid', '_ga', '_gl', 'yclid'}
+TRACKING_PREFIXES = ('utm_',)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonicalize_url(url):
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+
+    # Lower-case the host and drop the default port
+    netloc = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+
+    # Collapse duplicated slashes and drop the trailing one
+    path = re.sub(r'/{2,}', '/', parts.path) or '/'
+    if len(path) > 1:
+        path = path.rstrip('/')
+
+    # Drop tracking parameters and sort the rest
+    params = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+              if k.lower() not in TRACKING_PARAMS and not k.lower().startswith(TRACKING_PREFIXES)]
+    query = urlencode(sorted(params))
+
+    # The fragment never reaches the server
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def url_key(url):
+    # http and https variants of a canonical URL are the same page
+    return url.split('://', 1)[-1]
+
+
+class BloomFilter:
+    def __init__(self, capacity=1_000_000, error_rate=0.001) -> None:
+        # Optimal number of bits and hash functions for the expected number of items
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing, derives all positions from one digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+
+# Queue of URLs to crawl. URLs are deduplicated on their canonical form when
+# they are pushed, so every page is queued at most once. The queued URL is the
+# one pushed (without fragment): it is fetched and resolves relative links, so
+# e.g. the trailing slash of a directory page must be kept. `seen` selects an exact set or a
+# Bloom filter, which bounds the memory of the seen-set for large crawls at the
+# cost of skipping a small fraction (`error_rate`) of new URLs. With a
+# `priority` function or `prioritize=True` URLs are popped highest priority
+# first, otherwise in FIFO order.
+class Frontier:
+    def __init__(self, seen='set', capacity=1_000_000, error_rate=0.001,
+                 priority=None, prioritize=False, max_size=None) -> None:
+        if seen == 'bloom':
+            self.seen = BloomFilter(capacity, error_rate)
+        elif seen == 'set':
+            self.seen = set()
+        else:
+            raise ValueError(f"Unknown seen-set '{seen}', expected 'set' or 'bloom'.")
+
+        self.priority = priority
+        self.prioritized = prioritize or priority is not None
+        self.max_size = max_size
+        self.queue = deque()
+        self.heap = []
+        self.order = itertools.count()
+        self.dropped = 0
+
+    def push(self, url, priority=None):
+        url = urldefrag(url.strip())[0]
+        key = url_key(canonicalize_url(url))
+        if key in self.seen:
+            return False
+        if self.max_size and len(self) >= self.max_size:
+            self.dropped += 1
+            return False
+        self.seen.add(key)
+
+        if not self.prioritized:
+            self.queue.append(url)
+            return True
+
+        if priority is None:
+            priority = self.priority(url) if self.priority else 0.
+        # heapq is a min-heap, the counter keeps FIFO order for equal priorities
+        heapq.heappush(self.heap, (-priority, next(self.order), url))
+        return True
+
+    def mark_seen(self, url):
+        # Treat the URL as already crawled without queueing it
+        self.seen.add(url_key(canonicalize_url(url)))
+
+    def extend(self, urls):
+        return sum(self.push(url) for url in urls)
+
+    def pop(self):
+        if self.prioritized:
+            return heapq.heappop(self.heap)[2]
+        return self.queue.popleft()
+
+    def __len__(self):
+        return len(self.heap) if self.prioritized else len(self.queue)
@@ -0,0 +1,104 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+# Persistent cache of crawled pages. Pages are stored with their ETag and
+# Last-Modified headers and revalidated with a conditional request, so an
+# unchanged page costs a 304 instead of the full body. The least recently
+# used pages are evicted once the stored bodies exceed `max_size_mb`.
+class HttpCache:
+    def __init__(self, folder, max_size_mb=512) -> None:
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, 'http_cache.sqlite')
+        self.max_size = int(max_size_mb * 2**20)
+
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content BLOB,
+                size INTEGER,
+                last_access REAL)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_last_access ON pages (last_access)")
+            self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute("SELECT etag, last_modified, content FROM pages WHERE url = ?",
+                                    (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, content = row
+        return {'etag': etag, 'last_modified': last_modified, 'content': content}
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def touch(self, url):
+        # The page was revalidated (304), mark it as recently used
+        self.hits += 1
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE pages SET last_access = ? WHERE url = ?", (time.time(), url))
+
+    def store(self, url, response):
+        self.misses += 1
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        # Pages without validators can't be revalidated, there is no point in keeping them
+        if response.status_code != 200 or not (etag or last_modified):
+            return
+
+        content = response.content
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                              (url, etag, last_modified, content, len(content), time.time()))
+            self.size += len(content) - (row[0] if row else 0)
+            self.stored += 1
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # Drop the least recently used pages until the cache fits into its size cap
+        rows = self.conn.execute("SELECT url, size FROM pages ORDER BY last_access").fetchall()
+        for url, size in rows:
+            if self.size <= self.max_size:
+                break
+            self.conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self.size -= size
+            self.evicted += 1
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'requests': requests,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.,
+            'stored': self.stored,
+            'evicted': self.evicted,
+            'size_mb': self.size / 2**20,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,86 @@
+import os
+import glob
+import json
+import hashlib
+import logging
+
+from crawler import read_pages
+
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(text):
+    # Whitespace and case changes don't count as changed content
+    normalized = " ".join(text.lower().split())
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+
+
+def find_previous_folder(root_folder, name, exclude=None):
+    # The competitor folder of the latest earlier run that finished its summaries
+    runs = sorted(glob.glob(os.path.join(root_folder, 'competitor_analyze_*')), reverse=True)
+    for run in runs:
+        if exclude and os.path.abspath(run) == os.path.abspath(exclude):
+            continue
+        folder = os.path.join(run, name)
+        if os.path.exists(os.path.join(folder, f'summaries_{name}.json')):
+            return folder
+    return None
+
+
+# Results of an earlier run of a competitor, looked up by the hash of the page
+# text. Pages with the same text get the stored class and summary instead of
+# new LLM calls; the total summary and the analysis are reused when the page
+# summaries are the same as in the earlier run.
+class PreviousRun:
+    def __init__(self, folder, name) -> None:
+        self.folder = folder
+        self.pages = {}
+        self.page_summaries = []
+        self.total_summary = None
+        self.analysis = None
+        self.analysis_prompt_hash = None
+
+        with open(os.path.join(folder, f'summaries_{name}.json'), 'r', encoding='utf-8') as f:
+            summaries = json.load(f)
+        for entry in summaries:
+            if 'total_summary' in entry:
+                self.total_summary = entry['total_summary']
+                self.analysis_prompt_hash = entry.get('analysis_prompt_hash')
+                continue
+            page_hash = entry.get('content_hash') or content_hash(entry.get('text_content', ''))
+            self.pages[page_hash] = {'class': entry['class'], 'summary': entry['summary'], 'source': 'llm'}
+            if 'duplicate_of' not in entry:
+                self.page_summaries.append(entry['summary'])
+
+        # Excluded pages are only in the classes file, their text is in the content file
+        classes_file = os.path.join(folder, f'classes_{name}.json')
+        content_files = [os.path.join(folder, f'content_{name}.jsonl'), os.path.join(folder, f'content_{name}.json')]
+        content_file = next((path for path in content_files if os.path.exists(path)), None)
+        if os.path.exists(classes_file) and content_file:
+            with open(classes_file, 'r', encoding='utf-8') as f:
+                records = {record['url']: record for record in json.load(f)}
+            for item in read_pages(content_file):
+                record = records.get(item.get('url'))
+                if record is None:
+                    continue
+                page_hash = record.get('content_hash') or content_hash(item.get('text_content', ''))
+                page = self.pages.setdefault(page_hash, {'class': record['class'], 'summary': None})
+                page['source'] = record.get('source', 'llm')
+
+        res_file = os.path.join(folder, f'res_competitor_analysis_{name}.txt')
+        if os.path.exists(res_file):
+            with open(res_file, 'r', encoding='utf-8') as f:
+                self.analysis = f.read()
+
+        logger.info(f"Loaded {len(self.pages)} pages of the previous run in '{folder}'.")
+
+    def lookup(self, page_hash):
+        return self.pages.get(page_hash)
+
+    def same_summaries(self, page_summaries):
+        return sorted(page_summaries) == sorted(self.page_summaries)
@@ -0,0 +1,113 @@
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, key, description) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.key = key
+        self.description = description
+        self.status = 'queued'
+        # Latest stage and the (done, total) counters of every stage, stages may overlap
+        self.stage = None
+        self.stages = {}
+        self.text = ""
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    # Called from the worker thread while the job runs
+
+    def progress(self, stage, done=None, total=None):
+        with self.lock:
+            if stage not in self.stages:
+                self.stage = stage
+            old_done, old_total = self.stages.get(stage, (0, None))
+            self.stages[stage] = (old_done if done is None else done, old_total if total is None else total)
+
+    def append_text(self, piece):
+        with self.lock:
+            self.text += piece
+
+    # Read from the UI
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def snapshot(self):
+        with self.lock:
+            return {'id': self.id, 'description': self.description, 'status': self.status,
+                    'stage': self.stage, 'stages': dict(self.stages), 'text': self.text,
+                    'result': self.result, 'error': self.error, 'submitted_at': self.submitted_at,
+                    'started_at': self.started_at, 'finished_at': self.finished_at}
+
+
+# Runs jobs on a pool of background threads, so they outlive the request that
+# started them. A job submitted with the key of a queued or running job is not
+# started again, the running job is returned instead. The job function gets the
+# `Job` as first argument to report progress.
+class JobRunner:
+    def __init__(self, max_workers=2, keep_finished=100) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.keep_finished = keep_finished
+        self.jobs = {}
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, description, fn, *args, **kwargs) -> Job:
+        with self.lock:
+            job_id = self.active.get(key)
+            if job_id is not None:
+                return self.jobs[job_id]
+            job = Job(key, description)
+            self.jobs[job.id] = job
+            self.active[key] = job.id
+            self._forget_old()
+        self.executor.submit(contextvars.copy_context().run, self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        with job.lock:
+            job.status = 'running'
+            job.started_at = time.time()
+        # The final status and `finished_at` are set together, `finished_at` first: also
+        # readers without the lock (`finished`) never see a finished job without it
+        try:
+            result = fn(job, *args, **kwargs)
+            with job.lock:
+                job.result = result
+                job.finished_at = time.time()
+                job.status = 'done'
+        except Exception as ex:
+            logger.exception(f"Job {job.id} ({job.description}) failed.")
+            with job.lock:
+                job.error = f"{type(ex).__name__}: {ex}"
+                job.finished_at = time.time()
+                job.status = 'failed'
+        finally:
+            with self.lock:
+                self.active.pop(job.key, None)
+
+    def _forget_old(self):
+        finished = [job for job in self.jobs.values() if job.finished]
+        for job in sorted(finished, key=lambda job: job.finished_at)[:-self.keep_finished or None]:
+            del self.jobs[job.id]
+
+    def get(self, job_id) -> Job | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.submitted_at, reverse=True)
@@ -0,0 +1,117 @@
+import re
+import logging
+import threading
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+
+
+logger = logging.getLogger(__name__)
+
+
+# Language codes that are trusted when they show up as the first path segment, e.g. /de/...
+KNOWN_LANGUAGES = {'ar', 'bg', 'cs', 'da', 'de', 'el', 'en', 'es', 'et', 'fi', 'fr', 'he', 'hr', 'hu',
+                   'it', 'ja', 'ko', 'lt', 'lv', 'nl', 'no', 'pl', 'pt', 'ro', 'ru', 'sk', 'sl', 'sv',
+                   'tr', 'uk', 'zh'}
+
+LANG_SEGMENT = re.compile(r'^([a-z]{2})(?:[-_][a-z]{2,4})?$', re.IGNORECASE)
+
+
+def normalize_lang(code):
+    # "en-US", "en_gb" -> "en"
+    if not code:
+        return None
+    return re.split(r'[-_]', code.strip().lower())[0] or None
+
+
+# Decides whether a page is in one of the target languages, as cheaply as possible:
+#   1. from the URL: a language path segment (/de/) or a learned decision for the URL pattern
+#   2. from the <html lang> attribute of the page
+#   3. by running langdetect on a bounded sample of the text
+# Once `min_votes` pages of a URL pattern (host + first path segment) were all
+# detected as the same language, later pages of that pattern are decided from
+# the URL alone and are not fetched.
+class LanguageFilter:
+    def __init__(self, languages, sample_size=2000, min_votes=3, use_hints=True, seed=0) -> None:
+        self.languages = {normalize_lang(lan) for lan in languages}
+        self.sample_size = sample_size
+        self.min_votes = min_votes
+        self.use_hints = use_hints
+
+        # langdetect is random unless seeded, it is only imported when a text has to be detected
+        self.seed = seed
+
+        self.lock = threading.Lock()
+        self.pattern_votes = defaultdict(Counter)
+        self.pattern_langs = {}
+        self.stats = Counter()
+
+    def url_pattern(self, url):
+        parts = urlsplit(url)
+        segments = [seg for seg in parts.path.split('/') if seg]
+        # Pages at the site root have no pattern, their language is never assumed
+        if len(segments) < 2:
+            return None
+        return parts.netloc.lower(), segments[0].lower()
+
+    def url_language(self, url):
+        pattern = self.url_pattern(url)
+        if pattern is None:
+            return None
+        match = LANG_SEGMENT.match(pattern[1])
+        if match and match.group(1).lower() in KNOWN_LANGUAGES:
+            return match.group(1).lower()
+        return self.pattern_langs.get(pattern)
+
+    def accept_url(self, url):
+        # Reject pages before they are fetched if the URL already tells the language
+        lang = self.url_language(url)
+        if lang is not None and lang not in self.languages:
+            self.stats['rejected_by_url'] += 1
+            return False
+        return True
+
+    def accept_hreflang(self, hreflang):
+        lang = normalize_lang(hreflang)
+        return lang in (None, 'x') or lang in self.languages
+
+    def detect_hint(self, doc):
+        if not self.use_hints:
+            return None
+        return normalize_lang(doc.get_lang())
+
+    def detect_text(self, text):
+        # Detect on a sample from the middle of the text, where the page content usually is
+        if len(text) > self.sample_size:
+            start = (len(text) - self.sample_size) // 2
+            text = text[start:start + self.sample_size]
+        from langdetect import DetectorFactory, detect
+        from langdetect.lang_detect_exception import LangDetectException
+        DetectorFactory.seed = self.seed
+        try:
+            return normalize_lang(detect(text))
+        except LangDetectException:
+            return None
+
+    def record(self, url, lang):
+        pattern = self.url_pattern(url)
+        if pattern is None or lang is None:
+            return
+        with self.lock:
+            votes = self.pattern_votes[pattern]
+            votes[lang] += 1
+            # Cache the decision once the pattern is consistent
+            if len(votes) == 1 and votes[lang] >= self.min_votes:
+                self.pattern_langs[pattern] = lang
+            elif len(votes) > 1:
+                self.pattern_langs.pop(pattern, None)
+
+    def accept(self, lang, source):
+        accepted = lang in self.languages
+        self.stats[f"{'accepted' if accepted else 'rejected'}_by_{source}"] += 1
+        return accepted
+
+    def log_stats(self, name):
+        if self.stats:
+            stats = ", ".join(f"{key}={value}" for key, value in sorted(self.stats.items()))
+            logger.info(f"Language filter for '{name}': {stats}.")
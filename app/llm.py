@@ -1,46 +1,273 @@
+import os
+import time
+import random
 import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
-import openai
-from openai import chat
-from openai.types.chat.chat_completion import ChatCompletion
+from llm_cache import LLMCache
+from llm_metrics import LLMMetrics
+from tokens import count_tokens
+
+
+# openai takes long to import, it is only imported once a model is created
+if TYPE_CHECKING:
+    from openai.types.chat.chat_completion import ChatCompletion
 
 
 logger = logging.getLogger(__name__)
 
 
-class LLMModel:
-    _instance = None
+def retryable_errors():
+    # Errors worth retrying: rate limits, timeouts, connection problems and 5xx responses
+    import openai
+    return (openai.RateLimitError, openai.APITimeoutError,
+            openai.APIConnectionError, openai.InternalServerError)
+
+
+# Set in the threads of the LLM pool, nested `map` calls run inline there
+_worker = threading.local()
+
+
+def _run_in_worker(fn, item):
+    _worker.active = True
+    return fn(item)
 
-    def __init__(self, url: str, api_key: str, model_name: str) -> None:
+
+# Token bucket limiting requests and tokens per minute. A call waits until
+# both buckets hold enough budget; the buckets refill continuously.
+class RateLimiter:
+    def __init__(self, requests_per_min=None, tokens_per_min=None) -> None:
+        self.limits = {'requests': requests_per_min, 'tokens': tokens_per_min}
+        self.available = {key: float(limit) for key, limit in self.limits.items() if limit}
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        for key in self.available:
+            limit = self.limits[key]
+            self.available[key] = min(limit, self.available[key] + elapsed * limit / 60.)
+
+    def acquire(self, tokens=0):
+        if not self.available:
+            return
+        # A single call can never need more than a full bucket
+        needed = {'requests': 1., 'tokens': float(tokens)}
+        needed = {key: min(needed[key], self.limits[key]) for key in self.available}
+        while True:
+            with self.lock:
+                self._refill()
+                wait = max((needed[key] - self.available[key]) * 60. / self.limits[key]
+                           for key in self.available)
+                if wait <= 0:
+                    for key in self.available:
+                        self.available[key] -= needed[key]
+                    return
+            time.sleep(wait)
+
+
+class LLMModel:
+    def __init__(self, url: str, api_key: str, model_name: str,
+                 max_concurrency: int = 8, requests_per_min: int | None = None,
+                 tokens_per_min: int | None = None, max_retries: int = 5,
+                 timeout: float = 120., cache: LLMCache | None = None,
+                 context_tokens: int = 8192, metrics: LLMMetrics | None = None) -> None:
         self.url = url
         self.api_key = api_key
         self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        # Context window of the model, prompt and answer together
+        self.context_tokens = context_tokens
 
-        
+        # Retries are done here, with backoff shared by all callers
+        import openai
+        self.retryable_errors = retryable_errors()
         self.openai_client = openai.OpenAI(
             base_url=url,
-            api_key=api_key
+            api_key=api_key,
+            timeout=timeout,
+            max_retries=0
         )
-    
-    def chat(self, prompt, sys_prompt="", max_token=1000, temp=0.) -> ChatCompletion | None:
+        self.rate_limiter = RateLimiter(requests_per_min, tokens_per_min)
+        # Optional persistent response cache, only used for deterministic (temp 0) calls
+        self.cache = cache
+        # Tokens, latency and cost of every call, per competitor and stage
+        self.metrics = metrics or LLMMetrics()
+        self.executor = None
+        self.executor_lock = threading.Lock()
+
+    def _backoff(self, attempt, error):
+        # Prefer the delay asked for by the server
+        retry_after = None
+        response = getattr(error, 'response', None)
+        if response is not None:
+            retry_after = response.headers.get('retry-after')
         try:
-            response = self.openai_client.chat.completions.create(
-                model=self.model_name,
-                max_tokens=max_token,
-                temperature=temp,
-                messages=[
-                    {"role": "system", "content": sys_prompt},
-                    {"role": "user", "content": prompt},
-                ]
-            )
-        except Exception as e:
-            logger.error("Error in creating campaigns from openAI:", str(e))
-            return None
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return min(60., 2 ** attempt) * (0.5 + random.random())
+
+    def chat(self, prompt, sys_prompt="", max_token=1000, temp=0., use_cache=True,
+             tag="other") -> "ChatCompletion":
+        # `tag` names the calling stage in the metrics, e.g. "classifier"
+        start = time.perf_counter()
+        cache_key = None
+        if self.cache is not None and use_cache and temp == 0.:
+            cache_key = LLMCache.make_key(self.model_name, sys_prompt, prompt, max_token, temp)
+            response = self.cache.get(cache_key)
+            if response is not None:
+                self.metrics.record(tag, self.model_name, latency=time.perf_counter() - start, cache_hit=True)
+                return response
+
+        response, retries = self._chat(prompt, sys_prompt, max_token, temp, tag=tag, start=start)
+        usage = response.usage
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens = count_tokens(sys_prompt + prompt)
+            completion_tokens = count_tokens(response.choices[0].message.content or "")
+        self.metrics.record(tag, self.model_name, prompt_tokens, completion_tokens,
+                            time.perf_counter() - start, retries)
+        if cache_key is not None:
+            self.cache.put(cache_key, self.model_name, response)
         return response
 
-    def __new__(cls, url: str, api_key: str, model_name: str):
-        if not cls._instance:
-            cls._instance = super(LLMModel, cls).__new__(cls)
-            cls._instance.__init__(url, api_key, model_name)
-            
-        return cls._instance
+    def _chat(self, prompt, sys_prompt, max_token, temp, stream=False, tag="other", start=None):
+        # Returns the response and the number of retries it took
+        self.metrics.check_budget()
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(count_tokens(sys_prompt + prompt) + max_token)
+            try:
+                response = self.openai_client.chat.completions.create(
+                    model=self.model_name,
+                    max_tokens=max_token,
+                    temperature=temp,
+                    stream=stream,
+                    messages=[
+                        {"role": "system", "content": sys_prompt},
+                        {"role": "user", "content": prompt},
+                    ]
+                )
+                return response, attempt
+            except self.retryable_errors as e:
+                if attempt == self.max_retries:
+                    logger.error(f"LLM request failed after {attempt + 1} attempts: {e}")
+                    self._record_error(tag, attempt, start)
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning(f"LLM request failed ({type(e).__name__}), retrying in {delay:.1f}s.")
+                time.sleep(delay)
+            except Exception as e:
+                logger.error(f"LLM request failed: {e}")
+                self._record_error(tag, attempt, start)
+                raise
+
+    def _record_error(self, tag, retries, start):
+        latency = time.perf_counter() - start if start is not None else 0.
+        self.metrics.record(tag, self.model_name, latency=latency, retries=retries, error=True)
+
+    def chat_stream(self, prompt, sys_prompt="", max_token=1000, temp=0., use_cache=True, tag="other"):
+        # Like `chat`, but yields the text of the answer piece by piece as it arrives.
+        # Only opening the stream is retried, a stream failing halfway raises.
+        start = time.perf_counter()
+        cache_key = None
+        if self.cache is not None and use_cache and temp == 0.:
+            cache_key = LLMCache.make_key(self.model_name, sys_prompt, prompt, max_token, temp)
+            response = self.cache.get(cache_key)
+            if response is not None:
+                self.metrics.record(tag, self.model_name, latency=time.perf_counter() - start, cache_hit=True)
+                yield response.choices[0].message.content
+                return
+
+        stream, retries = self._chat(prompt, sys_prompt, max_token, temp, stream=True, tag=tag, start=start)
+        parts = []
+        finish_reason = None
+        response_id, created = None, None
+        usage = None
+        try:
+            for chunk in stream:
+                response_id, created = chunk.id, chunk.created
+                usage = getattr(chunk, 'usage', None) or usage
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                if choice.delta and choice.delta.content:
+                    parts.append(choice.delta.content)
+                    yield choice.delta.content
+        except Exception:
+            self._record_error(tag, retries, start)
+            raise
+
+        # Streams usually come without usage, then the tokens are counted here
+        content = "".join(parts)
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens, completion_tokens = count_tokens(sys_prompt + prompt), count_tokens(content)
+        self.metrics.record(tag, self.model_name, prompt_tokens, completion_tokens,
+                            time.perf_counter() - start, retries)
+
+        if cache_key is not None:
+            # Stored like a regular completion, so `chat` and `chat_stream` share the cache
+            from openai.types.chat.chat_completion import ChatCompletion
+            response = ChatCompletion.model_validate({
+                'id': response_id or 'stream',
+                'object': 'chat.completion',
+                'created': created or int(time.time()),
+                'model': self.model_name,
+                'choices': [{'index': 0, 'finish_reason': finish_reason or 'stop',
+                             'message': {'role': 'assistant', 'content': content}}],
+            })
+            self.cache.put(cache_key, self.model_name, response)
+
+    def map(self, fn, items):
+        # Run `fn` on all items with at most `max_concurrency` calls in flight, results keep the order
+        items = list(items)
+        # Waiting on the pool from inside the pool could deadlock
+        if len(items) <= 1 or self.max_concurrency <= 1 or getattr(_worker, 'active', False):
+            return [fn(item) for item in items]
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='llm')
+        futures = [self.executor.submit(contextvars.copy_context().run, _run_in_worker, fn, item)
+                   for item in items]
+        return [future.result() for future in futures]
+
+    def chat_many(self, requests) -> list["ChatCompletion"]:
+        # Each request is a dict of `chat` arguments
+        return self.map(lambda request: self.chat(**request), requests)
+
+
+def create_llm_models(settings, stages=None):
+    # `settings` are the `LLMModel` arguments of the default model, `stages` maps a
+    # stage name to the arguments it changes, e.g. {"classifier": {"model_name": ...}}.
+    # An endpoint's key is read from the environment variable named by `api_key_env`.
+    # Stages with the same settings share one model, and so its pool and rate limits.
+    # All models record into the metrics of the default one, so a run's usage and
+    # cost budget cover every stage.
+    default = LLMModel(**settings)
+    settings = {**settings, 'metrics': default.metrics}
+    models = {}
+    by_overrides = {(): default}
+    for stage, overrides in (stages or {}).items():
+        overrides = dict(overrides or {})
+        api_key_env = overrides.pop('api_key_env', None)
+        if api_key_env:
+            try:
+                overrides['api_key'] = os.environ[api_key_env]
+            except KeyError:
+                raise ValueError(f"Missing environment variable for stage '{stage}': {api_key_env}")
+        overrides = {key: value for key, value in overrides.items() if settings.get(key) != value}
+        key = tuple(sorted((name, repr(value)) for name, value in overrides.items()))
+        if key not in by_overrides:
+            by_overrides[key] = LLMModel(**{**settings, **overrides})
+        models[stage] = by_overrides[key]
+    return default, models
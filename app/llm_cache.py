@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai.types.chat.chat_completion import ChatCompletion
+
+
+logger = logging.getLogger(__name__)
+
+
+# Persistent cache of chat completions, keyed on everything that determines the
+# answer: model, system prompt, user prompt, max tokens and temperature. Entries
+# older than `max_age_days` are dropped, and the least recently used entries are
+# evicted beyond `max_entries`. With `bypass` the cache is not read but still
+# written, which refreshes the stored responses.
+class LLMCache:
+    def __init__(self, folder, max_entries=100_000, max_age_days=90, bypass=False) -> None:
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, 'llm_cache.sqlite')
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.bypass = bypass
+
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT,
+                created_at REAL,
+                last_access REAL)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_created_at ON responses (created_at)")
+            self._evict()
+
+    @staticmethod
+    def make_key(model, sys_prompt, prompt, max_tokens, temp):
+        key = json.dumps([model, sys_prompt, prompt, max_tokens, temp], ensure_ascii=False)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key) -> "ChatCompletion | None":
+        if self.bypass:
+            self.misses += 1
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.max_age and row[1] < time.time() - self.max_age:
+                row = None
+            if row is not None:
+                with self.conn:
+                    self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        from openai.types.chat.chat_completion import ChatCompletion
+        return ChatCompletion.model_validate_json(row[0])
+
+    def put(self, key, model, response: "ChatCompletion"):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                              (key, model, response.model_dump_json(), now, now))
+            self.puts += 1
+            # Evicting needs a scan, do it only every now and then
+            if self.puts % 100 == 0:
+                self._evict()
+
+    def _evict(self):
+        if self.max_age:
+            self.conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+        if self.max_entries:
+            self.conn.execute("""DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.,
+            'bypass': self.bypass,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,142 @@
+import os
+import json
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+logger = logging.getLogger(__name__)
+
+# Competitor (or other unit of work) the LLM calls of the current context are counted for
+current_scope = contextvars.ContextVar('llm_metrics_scope', default='-')
+
+COUNTERS = ['calls', 'cache_hits', 'errors', 'retries', 'prompt_tokens', 'completion_tokens',
+            'latency_sec', 'cost_usd']
+
+# (name, counter, help) of the exported Prometheus metrics
+PROMETHEUS_METRICS = [
+    ('llm_calls_total', 'calls', 'LLM calls, including cache hits'),
+    ('llm_cache_hits_total', 'cache_hits', 'LLM calls answered from the response cache'),
+    ('llm_errors_total', 'errors', 'LLM calls that failed after all retries'),
+    ('llm_retries_total', 'retries', 'Retried LLM requests'),
+    ('llm_prompt_tokens_total', 'prompt_tokens', 'Prompt tokens sent to the LLM endpoint'),
+    ('llm_completion_tokens_total', 'completion_tokens', 'Completion tokens received from the LLM endpoint'),
+    ('llm_latency_seconds_total', 'latency_sec', 'Time spent waiting for LLM calls'),
+    ('llm_cost_usd_total', 'cost_usd', 'Estimated cost of the LLM calls in USD'),
+]
+
+
+@contextmanager
+def metrics_scope(name):
+    token = current_scope.set(name)
+    try:
+        yield
+    finally:
+        current_scope.reset(token)
+
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+
+# Token, latency and cost accounting of LLM calls. Every call is recorded under
+# the current scope (the competitor), its stage tag (e.g. "classifier") and the
+# model. `pricing` maps model names to USD per million prompt and completion
+# tokens; calls are refused once the estimated cost reaches `max_cost_usd`.
+class LLMMetrics:
+    def __init__(self, pricing: dict | None = None, max_cost_usd: float | None = None) -> None:
+        self.pricing = pricing or {}
+        self.max_cost_usd = max_cost_usd
+        self.totals = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+        self.lock = threading.Lock()
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        price = self.pricing.get(model)
+        if not price:
+            return 0.
+        return (prompt_tokens * price.get('prompt', 0.) + completion_tokens * price.get('completion', 0.)) / 1e6
+
+    def check_budget(self):
+        if self.max_cost_usd is None:
+            return
+        spent = self.total()['cost_usd']
+        if spent >= self.max_cost_usd:
+            raise BudgetExceeded(f"LLM budget of ${self.max_cost_usd:.2f} used up (${spent:.2f} spent).")
+
+    def record(self, tag, model, prompt_tokens=0, completion_tokens=0, latency=0.,
+               retries=0, cache_hit=False, error=False):
+        key = (current_scope.get(), tag, model)
+        with self.lock:
+            entry = self.totals[key]
+            entry['calls'] += 1
+            entry['cache_hits'] += cache_hit
+            entry['errors'] += error
+            entry['retries'] += retries
+            entry['latency_sec'] += latency
+            # Cached answers cost nothing, their tokens are not counted
+            if not cache_hit:
+                entry['prompt_tokens'] += prompt_tokens
+                entry['completion_tokens'] += completion_tokens
+                entry['cost_usd'] += self.cost(model, prompt_tokens, completion_tokens)
+
+    def clear(self, scope):
+        with self.lock:
+            for key in [key for key in self.totals if key[0] == scope]:
+                del self.totals[key]
+
+    def total(self, scope=None):
+        total = dict.fromkeys(COUNTERS, 0)
+        with self.lock:
+            for (entry_scope, _, _), entry in self.totals.items():
+                if scope is None or entry_scope == scope:
+                    for counter in COUNTERS:
+                        total[counter] += entry[counter]
+        return total
+
+    def summary(self, scope=None):
+        # Totals per stage (and model), of one scope or of everything
+        stages = []
+        with self.lock:
+            for (entry_scope, tag, model), entry in sorted(self.totals.items()):
+                if scope is None or entry_scope == scope:
+                    stage = {'scope': entry_scope, 'stage': tag, 'model': model, **entry}
+                    stage['avg_latency_sec'] = entry['latency_sec'] / entry['calls'] if entry['calls'] else 0.
+                    stages.append(stage)
+        return {'total': self.total(scope), 'stages': stages}
+
+    def save(self, path, scope=None):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(scope), f, ensure_ascii=False, indent=4)
+
+    def export_prometheus(self, path):
+        # Textfile collector format, written atomically so the exporter never reads half a file
+        lines = []
+        with self.lock:
+            items = sorted(self.totals.items())
+        for name, counter, help_text in PROMETHEUS_METRICS:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for (scope, tag, model), entry in items:
+                labels = ",".join(f'{label}="{_escape(value)}"'
+                                  for label, value in [('competitor', scope), ('stage', tag), ('model', model)])
+                lines.append(f"{name}{{{labels}}} {entry[counter]}")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def log_summary(self, scope=None):
+        summary = self.summary(scope)
+        lines = [f"{'competitor':<20} {'stage':<16} {'model':<28} {'calls':>6} {'cached':>6} {'prompt':>9} "
+                 f"{'completion':>10} {'time [s]':>9} {'cost [$]':>9}"]
+        for s in summary['stages']:
+            lines.append(f"{s['scope']:<20} {s['stage']:<16} {s['model']:<28} {s['calls']:>6} {s['cache_hits']:>6} "
+                         f"{s['prompt_tokens']:>9} {s['completion_tokens']:>10} {s['latency_sec']:>9.1f} "
+                         f"{s['cost_usd']:>9.3f}")
+        logger.info("LLM usage:\n" + "\n".join(lines))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
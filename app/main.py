@@ -1,20 +1,103 @@
 import os
+import sys
+import json
+import time
 import argparse
 import yaml
 import datetime
 import logging 
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 
 from analyzer import CompetitorAnalyzer
-from llm import LLMModel
+from llm import create_llm_models
+from llm_cache import LLMCache
+from llm_metrics import LLMMetrics, metrics_scope
+from preclassifier import PreClassifier
+from incremental import find_previous_folder
+from store import ResultsStore
+
+# Name of the competitor analyzed by the current worker, added to every log record
+current_competitor = contextvars.ContextVar('current_competitor', default='-')
+
+
+class CompetitorLogFilter(logging.Filter):
+    def filter(self, record):
+        record.competitor = current_competitor.get()
+        return True
+
 
 # Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(competitor)s] %(message)s')
+for handler in logging.getLogger().handlers:
+    handler.addFilter(CompetitorLogFilter())
 logger = logging.getLogger(__name__)
 
 
-def main(config_file):
+def run_competitor(comp, root_folder, analyzer_kwargs, analyze_kwargs, previous_root=None, store=None,
+                   embedding_index=None, embedder=None):
+    name = comp['name']
+    current_competitor.set(name)
+    started_at = time.time()
+    status = {'name': name, 'status': 'ok', 'error': None, 'started_at': datetime.datetime.now().isoformat()}
+    start = time.perf_counter()
+    base_folder = f"{root_folder}/{name}"
+    try:
+        os.makedirs(base_folder, exist_ok=True)
+
+        # Unchanged pages reuse the results of the latest earlier run
+        previous_folder = find_previous_folder(previous_root, name, exclude=root_folder) if previous_root else None
+
+        # Crete and run the analyzer
+        analyzer = CompetitorAnalyzer(**analyzer_kwargs)
+        analyzer.analyze(base_folder=base_folder, name=name,
+                         allowed_domains=comp['allowed_domains'], start_urls=comp['start_urls'],
+                         previous_folder=previous_folder, **analyze_kwargs)
+    except Exception as ex:
+        # A failing competitor must not abort the others
+        logger.exception(f"Competitor analysis for '{name}' failed.")
+        status['status'] = 'failed'
+        status['error'] = f"{type(ex).__name__}: {ex}"
+    status['duration_sec'] = round(time.perf_counter() - start, 1)
+
+    if store is not None:
+        try:
+            store.record_run(name, base_folder, product=analyzer_kwargs['product_name'], source='cli',
+                             status=status['status'], error=status['error'], started_at=started_at)
+        except Exception:
+            logger.exception(f"Storing the results of '{name}' failed.")
+
+    if embedding_index is not None and status['status'] == 'ok':
+        # Only summaries that are new since the earlier runs are embedded
+        try:
+            from embeddings import index_folder
+            with metrics_scope(name):
+                index_folder(embedding_index, embedder, base_folder, name)
+            embedding_index.save()
+        except Exception:
+            logger.exception(f"Embedding the summaries of '{name}' failed.")
+    return status
+
+
+def write_run_summary(root_folder, statuses, duration):
+    summary = {
+        'duration_sec': round(duration, 1),
+        'num_ok': sum(s['status'] == 'ok' for s in statuses),
+        'num_failed': sum(s['status'] == 'failed' for s in statuses),
+        'competitors': statuses,
+    }
+    with open(f"{root_folder}/run_summary.json", 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=4)
+
+    lines = [f"{'competitor':<30} {'status':<8} {'time [s]':>9}"]
+    lines += [f"{s['name']:<30} {s['status']:<8} {s['duration_sec']:>9.1f}" for s in statuses]
+    logger.info("Run summary:\n" + "\n".join(lines))
+    return summary
+
+
+def main(config_file, resume_folder=None, workers=1, bypass_llm_cache=False, full=False):
     with open(config_file, "r") as f:
         config = yaml.safe_load(f)
     competitors = config['competitors']
@@ -24,6 +107,18 @@ def main(config_file):
     max_pages = config["application"]["max-pages"]
     product_name = config["product"]["name"]
     product_desc = config["product"]["description"]
+    crawler_settings = dict(config["application"].get("crawler", {}))
+    dedupe_threshold = config["application"].get("dedupe-threshold")
+    classify_batch_size = config["application"].get("classify-batch-size", 1)
+    preclassifier_settings = dict(config["application"].get("preclassifier", {}))
+    llm_settings = config["application"].get("llm", {})
+    stage_settings = config["application"].get("models") or {}
+    pipeline_settings = dict(config["application"].get("pipeline", {}))
+    llm_cache_settings = dict(config["application"].get("llm-cache", {}))
+    llm_metrics_settings = dict(config["application"].get("llm-metrics", {}))
+    incremental = config["application"].get("incremental", False) and not full
+    results_store_settings = dict(config["application"].get("results-store", {}))
+    embedding_settings = dict(config["application"].get("embeddings", {}))
 
     # Load variables from .env file
     load_dotenv()
@@ -33,37 +128,110 @@ def main(config_file):
     except KeyError as e:
         raise ValueError(f"Missing environment variable: {e.args[0]}")
 
-    # Create the LLM model
-    llm_model = LLMModel(url, api_key, model_name)
+    # Cache LLM responses under the root folder, so unchanged prompts are not paid again
+    llm_cache = None
+    if llm_cache_settings.pop("enabled", False):
+        llm_cache = LLMCache(f"{root_folder}/llm_cache", bypass=bypass_llm_cache, **llm_cache_settings)
+
+    # Tokens, latency and cost of the LLM calls per competitor and stage
+    prometheus_file = llm_metrics_settings.pop("prometheus_file", None)
+    llm_metrics = LLMMetrics(**llm_metrics_settings)
+
+    # Create the LLM models, the default one and those of stages routed elsewhere
+    llm_model, stage_models = create_llm_models(
+        dict(url=url, api_key=api_key, model_name=model_name, cache=llm_cache, metrics=llm_metrics, **llm_settings),
+        stage_settings)
+    for stage, model in stage_models.items():
+        logger.info(f"LLM stage '{stage}' uses model '{model.model_name}' at {model.url}.")
     
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    root_folder = f"{root_folder}/competitor_analyze_{timestamp}"
-    os.makedirs(root_folder)
+    # The HTTP cache is shared by all runs under the root folder
+    if crawler_settings.pop("cache", False):
+        crawler_settings["cache_dir"] = f"{root_folder}/http_cache"
 
-    for comp in competitors:
-        name = comp['name']
-        allowed_domains = comp['allowed_domains']
-        start_urls = comp['start_urls']
+    # Runs, pages, classes, summaries and analyses of all runs, queried across runs
+    store = None
+    if results_store_settings.get("enabled", False):
+        store = ResultsStore(results_store_settings.get("path") or f"{root_folder}/results.sqlite")
 
-        base_folder = f"{root_folder}/{name}"
-        os.makedirs(base_folder)
+    # Embeddings of the summaries of all runs, for semantic search across competitors
+    embedding_index, embedder = None, None
+    if embedding_settings.pop("enabled", False):
+        # numpy takes long to import, embeddings are only imported when enabled
+        from embeddings import EmbeddingIndex, create_embedder
+        embedding_index = EmbeddingIndex(embedding_settings.pop("folder", None) or f"{root_folder}/embeddings")
+        embedder = create_embedder(dict(url=url, api_key=api_key, metrics=llm_metrics, **embedding_settings))
 
-        # Crete and run the analyzer
-        analyzer = CompetitorAnalyzer(
-            llm_model=llm_model,
-            product_name=product_name,
-            product_desc=product_desc)
-        
-        analyzer.analyze(base_folder=base_folder, name=name, 
-                         allowed_domains=allowed_domains, start_urls=start_urls, 
-                         languages=languages, max_pages=max_pages)
+    # Earlier runs are looked up under the configured root folder
+    previous_root = root_folder if incremental else None
+
+    if resume_folder:
+        # Continue the crawls of an interrupted run from their content files
+        root_folder = resume_folder
+    else:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        root_folder = f"{root_folder}/competitor_analyze_{timestamp}"
+    os.makedirs(root_folder, exist_ok=True)
+
+    # Shared by all competitors, labels obvious pages without an LLM call
+    preclassifier = None
+    if preclassifier_settings.pop("enabled", False):
+        preclassifier = PreClassifier(**preclassifier_settings)
+
+    analyzer_kwargs = dict(
+        llm_model=llm_model,
+        stage_models=stage_models,
+        product_name=product_name,
+        product_desc=product_desc,
+        crawler_settings=crawler_settings,
+        dedupe_threshold=dedupe_threshold,
+        classify_batch_size=classify_batch_size,
+        preclassifier=preclassifier,
+        pipeline=pipeline_settings if pipeline_settings.pop("enabled", False) else None)
+    analyze_kwargs = dict(languages=languages, max_pages=max_pages)
+
+    # Competitors are independent, each worker analyzes one competitor at a time
+    start = time.perf_counter()
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='competitor') as executor:
+            futures = [executor.submit(contextvars.copy_context().run, run_competitor,
+                                       comp, root_folder, analyzer_kwargs, analyze_kwargs, previous_root, store,
+                                       embedding_index, embedder)
+                       for comp in competitors]
+            statuses = [future.result() for future in futures]
+    else:
+        statuses = [contextvars.copy_context().run(run_competitor, comp, root_folder,
+                                                   analyzer_kwargs, analyze_kwargs, previous_root, store,
+                                                   embedding_index, embedder)
+                    for comp in competitors]
 
-    logger.info("Competio")
+    summary = write_run_summary(root_folder, statuses, time.perf_counter() - start)
+    if llm_cache:
+        stats = llm_cache.stats()
+        logger.info(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {stats['hit_rate']:.0%}).")
+        llm_cache.close()
+    if store:
+        store.close()
+    llm_metrics.save(f"{root_folder}/llm_metrics.json")
+    llm_metrics.log_summary()
+    if prometheus_file:
+        llm_metrics.export_prometheus(prometheus_file)
+    logger.info(f"Competitor analysis completed: {summary['num_ok']} succeeded, {summary['num_failed']} failed.")
+    return summary
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Competitor Analysis Application')
     parser.add_argument('-c', '--config', type=str, default='config.yaml',
                         help='Path to the configuration file (default: config.yaml)')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='Folder of an interrupted run to continue (e.g. results/competitor_analyze_<timestamp>)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of competitors analyzed in parallel (default: 1)')
+    parser.add_argument('--bypass-llm-cache', action='store_true',
+                        help='Ignore cached LLM responses (new responses are still cached)')
+    parser.add_argument('--full', action='store_true',
+                        help='Analyze all pages again instead of reusing the results of unchanged pages')
     args = parser.parse_args()
     config_file = args.config
-    main(config_file)
+    summary = main(config_file, resume_folder=args.resume, workers=args.workers,
+                   bypass_llm_cache=args.bypass_llm_cache, full=args.full)
+    sys.exit(1 if summary['num_failed'] else 0)
@@ -0,0 +1,93 @@
+from urllib.parse import urljoin
+
+
+# Backends that can be passed as `parser` to the crawler. `lxml` and
+# `selectolax` are optional dependencies and only imported when selected.
+PARSER_BACKENDS = ['html.parser', 'lxml', 'selectolax']
+
+SKIP_TAGS = ['style', 'script']
+HEADING_TAGS = ['h1', 'h2']
+
+
+class BeautifulSoupDocument:
+    def __init__(self, content, features='html.parser'):
+        from bs4 import BeautifulSoup
+        self.soup = BeautifulSoup(content, features)
+
+    def get_text(self):
+        try:
+            # Find the main content container
+            main_content = self.soup.find("div", class_="main-content")  # Adjust the class name according to the website's structure
+
+            # Extract the text content from the main content container
+            text_content = main_content.get_text(strip=True)
+        except Exception:
+            # Extract the text content of the page, excluding <style> and <script> tags
+            text_content = ' '.join([element.get_text(strip=True) for element in self.soup.find_all(string=True) if element.parent.name not in SKIP_TAGS])
+        return text_content
+
+    def get_links(self, base_url):
+        return [urljoin(base_url, link.get('href')) for link in self.soup.find_all('a', href=True)]
+
+    def get_title(self):
+        title = self.soup.find('title')
+        return title.get_text(strip=True) if title is not None else ""
+
+    def get_headings(self, max_headings=10):
+        return [h.get_text(' ', strip=True) for h in self.soup.find_all(HEADING_TAGS, limit=max_headings)]
+
+    def get_lang(self):
+        html = self.soup.find('html')
+        return html.get('lang') if html is not None else None
+
+    def get_alternates(self, base_url):
+        # (url, language) of the translations of the page
+        return [(urljoin(base_url, link.get('href')), link.get('hreflang'))
+                for link in self.soup.find_all(['link', 'a'], href=True, hreflang=True)]
+
+
+class SelectolaxDocument:
+    def __init__(self, content):
+        from selectolax.lexbor import LexborHTMLParser
+        self.tree = LexborHTMLParser(content)
+
+    def get_text(self):
+        main_content = self.tree.css_first("div.main-content")
+        if main_content is not None:
+            return main_content.text(strip=True)
+
+        self.tree.strip_tags(SKIP_TAGS)
+        root = self.tree.body or self.tree.root
+        if root is None:
+            return ""
+        return root.text(separator=' ', strip=True)
+
+    def get_links(self, base_url):
+        return [urljoin(base_url, node.attributes['href']) for node in self.tree.css('a[href]')
+                if node.attributes.get('href') is not None]
+
+    def get_title(self):
+        title = self.tree.css_first('title')
+        return title.text(strip=True) if title is not None else ""
+
+    def get_headings(self, max_headings=10):
+        return [h.text(separator=' ', strip=True) for h in self.tree.css(', '.join(HEADING_TAGS))][:max_headings]
+
+    def get_lang(self):
+        html = self.tree.css_first('html')
+        return html.attributes.get('lang') if html is not None else None
+
+    def get_alternates(self, base_url):
+        # (url, language) of the translations of the page
+        return [(urljoin(base_url, node.attributes['href']), node.attributes['hreflang'])
+                for node in self.tree.css('link[href][hreflang], a[href][hreflang]')
+                if node.attributes.get('href') is not None]
+
+
+def parse_html(content, parser='html.parser'):
+    # Parse the page once, text and links are then read from the same document
+    if parser == 'selectolax':
+        return SelectolaxDocument(content)
+    if parser in ('html.parser', 'lxml'):
+        return BeautifulSoupDocument(content, parser)
+    raise ValueError(f"Unknown parser backend '{parser}', expected one of {PARSER_BACKENDS}.")
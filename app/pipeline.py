@@ -0,0 +1,137 @@
+import time
+import queue
+import logging
+import threading
+import contextvars
+from collections import Counter
+
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the stream in a queue
+_STOP = object()
+
+
+class Stage:
+    # `fn` takes a list of up to `batch_size` items and returns the items passed
+    # to the next stage. A worker waits up to `max_wait` seconds to fill a batch.
+    def __init__(self, name, fn, workers=1, batch_size=1, max_wait=0.) -> None:
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait
+
+
+# Runs stages concurrently, connected by bounded queues: a stage works on the
+# first items while the earlier stages still produce the next ones, and a full
+# queue slows down the stage feeding it. `run` feeds the items produced by
+# `source(emit)` through the stages and yields the output of the last stage.
+# If a stage fails, the remaining items are drained and the error is raised
+# once the pipeline has stopped.
+class Pipeline:
+    def __init__(self, stages, queue_size=64) -> None:
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self.error = None
+        self.error_lock = threading.Lock()
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+
+    def fail(self, where, ex):
+        logger.exception(f"Pipeline stage '{where}' failed.")
+        with self.error_lock:
+            if self.error is None:
+                self.error = ex
+
+    def add_stat(self, key, value):
+        with self.stats_lock:
+            self.stats[key] += value
+
+    def _source(self, source):
+        out = self.queues[0]
+
+        def emit(item):
+            out.put(item)
+            self.add_stat('source_items', 1)
+
+        try:
+            start = time.perf_counter()
+            source(emit)
+            self.add_stat('source_sec', time.perf_counter() - start)
+        except Exception as ex:
+            self.fail('source', ex)
+        finally:
+            out.put(_STOP)
+
+    def _next_batch(self, stage, inbox):
+        item = inbox.get()
+        if item is _STOP:
+            return None, True
+        batch = [item]
+        deadline = time.monotonic() + stage.max_wait
+        while len(batch) < stage.batch_size:
+            try:
+                item = inbox.get(timeout=max(0., deadline - time.monotonic())) if stage.max_wait else inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _worker(self, stage, inbox, outbox, done):
+        while True:
+            batch, stopped = self._next_batch(stage, inbox)
+            if batch:
+                if self.error is None:
+                    try:
+                        start = time.perf_counter()
+                        results = stage.fn(batch)
+                        self.add_stat(f"{stage.name}_sec", time.perf_counter() - start)
+                        self.add_stat(f"{stage.name}_items", len(batch))
+                        for item in results:
+                            outbox.put(item)
+                    except Exception as ex:
+                        self.fail(stage.name, ex)
+                # After a failure the items are dropped, so the stages before don't block
+            if stopped:
+                # Let the other workers of the stage stop too, the last one stops the next stage
+                inbox.put(_STOP)
+                with done['lock']:
+                    done['workers'] -= 1
+                    if done['workers'] == 0:
+                        outbox.put(_STOP)
+                return
+
+    def run(self, source):
+        threads = [threading.Thread(target=contextvars.copy_context().run, args=(self._source, source),
+                                    name='pipeline-source', daemon=True)]
+        for i, stage in enumerate(self.stages):
+            done = {'workers': stage.workers, 'lock': threading.Lock()}
+            for n in range(stage.workers):
+                # Each thread runs in its own copy of the caller's context (logging, metrics)
+                threads.append(threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(self._worker, stage, self.queues[i], self.queues[i + 1], done),
+                    name=f'pipeline-{stage.name}-{n}', daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        output = self.queues[-1]
+        while (item := output.get()) is not _STOP:
+            yield item
+        for thread in threads:
+            thread.join()
+        self.stats['total_sec'] = time.perf_counter() - start
+
+        self.log_stats()
+        if self.error is not None:
+            raise self.error
+
+    def log_stats(self):
+        parts = [f"source {self.stats['source_items']} items in {self.stats['source_sec']:.1f}s"]
+        parts += [f"{stage.name} {self.stats[f'{stage.name}_items']} items in "
+                  f"{self.stats[f'{stage.name}_sec']:.1f}s ({stage.workers} workers)" for stage in self.stages]
+        logger.info(f"Pipeline finished in {self.stats['total_sec']:.1f}s: " + ", ".join(parts) + ".")
@@ -0,0 +1,167 @@
+import os
+import re
+import glob
+import json
+import pickle
+import logging
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import urlsplit
+
+from classifier import ContentTypes
+
+
+logger = logging.getLogger(__name__)
+
+
+# (content type, URL path segment pattern, confidence). A rule counts fully for
+# the top level section (after an optional locale) and for sections nested in
+# other known ones (/about/team), deeper matches like /features/team only get
+# DEEP_URL_FACTOR of it, so they stay below the threshold unless the title agrees.
+URL_RULES = [
+    (ContentTypes.blog, r'blog|blogs|news|article|articles|post|posts|insights|magazin|magazine', 0.9),
+    (ContentTypes.contact, r'contact|contact-us|kontakt|contacto|get-in-touch', 0.95),
+    (ContentTypes.price, r'pricing|prices|price|preise|plans|tarife', 0.9),
+    (ContentTypes.team, r'team|our-team|leadership|management|people|founders', 0.9),
+    (ContentTypes.faq, r'faq|faqs|frequently-asked-questions|haeufige-fragen', 0.95),
+    (ContentTypes.testimonial, r'testimonials|reviews|success-stories|references|referenzen', 0.85),
+    (ContentTypes.about, r'about|about-us|ueber-uns|uber-uns|company|unternehmen', 0.85),
+    (ContentTypes.others, r'careers|jobs|karriere|legal|privacy|datenschutz|imprint|impressum|terms', 0.9),
+]
+DEEP_URL_FACTOR = 0.5
+LOCALE_SEGMENT = re.compile(r'[a-z]{2}([-_][a-z]{2,4})?', re.IGNORECASE)
+
+# (content type, title/heading pattern, confidence)
+TITLE_RULES = [
+    (ContentTypes.contact, r'\b(contact us|get in touch|kontakt)\b', 0.85),
+    (ContentTypes.price, r'\b(pricing|plans & pricing|preise)\b', 0.85),
+    (ContentTypes.faq, r'\b(faq|frequently asked questions|häufige fragen)\b', 0.9),
+    (ContentTypes.team, r'\b(our team|meet the team|leadership team|unser team)\b', 0.85),
+    (ContentTypes.blog, r'\b(blog)\b', 0.75),
+    (ContentTypes.testimonial, r'\b(testimonials|customer stories|success stories)\b', 0.8),
+    (ContentTypes.about, r'\b(about us|über uns)\b', 0.8),
+]
+
+URL_PATTERNS = [(cls, re.compile(pattern, re.IGNORECASE), conf) for cls, pattern, conf in URL_RULES]
+TITLE_PATTERNS = [(cls, re.compile(pattern, re.IGNORECASE), conf) for cls, pattern, conf in TITLE_RULES]
+
+
+def url_votes(path):
+    # (content type, confidence) of the rules matching a path segment
+    segments = [segment for segment in path.split('/') if segment]
+    if segments and LOCALE_SEGMENT.fullmatch(segments[0]):
+        segments = segments[1:]
+    anchored = True
+    for segment in segments:
+        matches = [(cls, conf) for cls, pattern, conf in URL_PATTERNS if pattern.fullmatch(segment)]
+        for cls, conf in matches:
+            yield cls, conf if anchored else conf * DEEP_URL_FACTOR
+        # Below an unknown section (/features/..., /product/...) rules only hint
+        anchored = anchored and bool(matches)
+
+
+def model_input(item):
+    # Text the trained model sees: URL path words, title, headings and the start of the page
+    path = re.sub(r'[/\-_.]+', ' ', urlsplit(item['url']).path)
+    return " ".join([path, item.get('title', ''), " ".join(item.get('headings', [])),
+                     item.get('text_content', '')[:2000]])
+
+
+# Classifies obvious pages locally, so they don't need an LLM call. The URL
+# path, the title and the headings are matched against rules, and an optional
+# TF-IDF model trained on earlier LLM labels (see `train`) adds a prediction.
+# A page is only labelled locally if the best confidence reaches `threshold`.
+class PreClassifier:
+    def __init__(self, threshold=0.85, model_path=None) -> None:
+        self.threshold = threshold
+        self.model = None
+        if model_path and os.path.exists(model_path):
+            with open(model_path, 'rb') as f:
+                self.model = pickle.load(f)
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def predict(self, item):
+        # Returns the best (content type, confidence), or (None, 0.)
+        votes = Counter()
+        for cls, conf in url_votes(urlsplit(item['url']).path):
+            votes[cls] = max(votes[cls], conf)
+
+        title = " ".join([item.get('title', '')] + item.get('headings', [])[:3])
+        for cls, pattern, conf in TITLE_PATTERNS:
+            if pattern.search(title):
+                # Agreeing rules strengthen each other
+                votes[cls] = 1. - (1. - votes[cls]) * (1. - conf)
+
+        if self.model is not None:
+            probs = self.model.predict_proba([model_input(item)])[0]
+            best = probs.argmax()
+            cls = ContentTypes(self.model.classes_[best])
+            votes[cls] = max(votes[cls], float(probs[best]))
+
+        if not votes:
+            return None, 0.
+        return max(votes.items(), key=lambda vote: vote[1])
+
+    def classify(self, item) -> ContentTypes | None:
+        cls, confidence = self.predict(item)
+        accepted = cls is not None and confidence >= self.threshold
+        with self.lock:
+            self.stats['pages'] += 1
+            self.stats['llm_calls_avoided'] += accepted
+        return cls if accepted else None
+
+
+def load_training_data(results_folder):
+    # Pages of earlier runs with the class the LLM gave them
+    texts, labels = [], []
+    for classes_file in glob.glob(os.path.join(results_folder, '**', 'classes_*.json'), recursive=True):
+        folder = os.path.dirname(classes_file)
+        name = os.path.basename(classes_file)[len('classes_'):-len('.json')]
+        content_file = os.path.join(folder, f'content_{name}.jsonl')
+        if not os.path.exists(content_file):
+            continue
+
+        with open(classes_file, 'r', encoding='utf-8') as f:
+            classes = {entry['url']: entry['class'] for entry in json.load(f) if entry.get('source') == 'llm'}
+        with open(content_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if item.get('url') in classes:
+                    texts.append(model_input(item))
+                    labels.append(classes[item['url']])
+    return texts, labels
+
+
+def train(results_folder, model_path):
+    # scikit-learn is only needed to train and use the model, not for the rules
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+
+    texts, labels = load_training_data(results_folder)
+    if len(set(labels)) < 2:
+        raise ValueError(f"Need LLM labels of at least two classes in '{results_folder}', found {len(set(labels))}.")
+
+    model = make_pipeline(TfidfVectorizer(sublinear_tf=True, max_features=50_000, ngram_range=(1, 2)),
+                          LogisticRegression(max_iter=1000, class_weight='balanced'))
+    model.fit(texts, labels)
+    with open(model_path, 'wb') as f:
+        pickle.dump(model, f)
+    logger.info(f"Trained pre-classifier on {len(texts)} pages ({dict(Counter(labels))}), saved to '{model_path}'.")
+    return model
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Train the local pre-classifier on earlier LLM labels')
+    parser.add_argument('--results', type=str, default='results',
+                        help='Folder with earlier runs (default: results)')
+    parser.add_argument('--out', type=str, default='results/preclassifier.pkl',
+                        help='Where to save the model (default: results/preclassifier.pkl)')
+    args = parser.parse_args()
+    train(args.results, args.out)
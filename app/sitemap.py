@@ -0,0 +1,119 @@
+import io
+import re
+import gzip
+import logging
+import datetime
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+
+
+logger = logging.getLogger(__name__)
+
+
+# Path keywords of pages that tell most about the product, and of pages that tell little
+VALUABLE_KEYWORDS = ['product', 'solution', 'feature', 'platform', 'service', 'use-case', 'usecase',
+                     'integration', 'industr', 'customer', 'about', 'why', 'how-it-works']
+LOW_VALUE_KEYWORDS = ['blog', 'news', 'press', 'event', 'webinar', 'tag', 'category', 'author',
+                      'archive', 'career', 'job', 'legal', 'privacy', 'imprint', 'impressum',
+                      'terms', 'cookie', 'login', 'signin', 'signup', 'cart', 'search']
+PAGINATION = re.compile(r'/page/\d+|[?&]page=\d+')
+# Largest (uncompressed) sitemap allowed by the sitemap protocol
+MAX_SITEMAP_BYTES = 50 * 1024 * 1024
+
+
+def url_priority(url, lastmod=None):
+    # Higher is crawled first: product pages near the root, recently modified
+    parts = urlsplit(url)
+    path = parts.path.lower()
+    score = -0.5 * path.strip('/').count('/')
+
+    if any(keyword in path for keyword in VALUABLE_KEYWORDS):
+        score += 2.
+    if any(keyword in path for keyword in LOW_VALUE_KEYWORDS):
+        score -= 2.
+    if PAGINATION.search(f"{path}?{parts.query}"):
+        score -= 2.
+
+    if lastmod is not None:
+        age_days = max(0., (datetime.datetime.now(datetime.timezone.utc) - lastmod).total_seconds() / 86400)
+        score += 1. / (1. + age_days / 30.)
+    return score
+
+
+def parse_lastmod(value):
+    if not value:
+        return None
+    try:
+        lastmod = datetime.datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if lastmod.tzinfo is None:
+        lastmod = lastmod.replace(tzinfo=datetime.timezone.utc)
+    return lastmod
+
+
+def parse_sitemap(content, max_bytes=MAX_SITEMAP_BYTES):
+    # Returns the pages (url, lastmod) and the nested sitemaps of a sitemap or sitemap index.
+    # Gzip sitemaps are decompressed up to `max_bytes`, a small file can expand to gigabytes.
+    if content[:2] == b'\x1f\x8b':
+        with gzip.GzipFile(fileobj=io.BytesIO(content)) as f:
+            content = f.read(max_bytes + 1)
+    if len(content) > max_bytes:
+        raise ValueError(f"sitemap larger than {max_bytes // (1024 * 1024)} MB, skipped")
+
+    pages, sitemaps = [], []
+    root = ET.fromstring(content)
+    # Compare tag names without the XML namespace
+    is_index = root.tag.endswith('sitemapindex')
+    for entry in root:
+        loc = lastmod = None
+        for child in entry:
+            if child.tag.endswith('loc'):
+                loc = (child.text or '').strip()
+            elif child.tag.endswith('lastmod'):
+                lastmod = parse_lastmod(child.text)
+        if not loc:
+            continue
+        if is_index:
+            sitemaps.append(loc)
+        else:
+            pages.append((loc, lastmod))
+    return pages, sitemaps
+
+
+def read_sitemaps(session, sitemap_urls, timeout=30, max_urls=5000, max_sitemaps=50):
+    # Follow sitemap indexes breadth-first until enough page URLs are found
+    pages = []
+    queue = list(sitemap_urls)
+    visited = set()
+    while queue and len(pages) < max_urls and len(visited) < max_sitemaps:
+        sitemap_url = queue.pop(0)
+        if sitemap_url in visited:
+            continue
+        visited.add(sitemap_url)
+        try:
+            response = session.get(sitemap_url, timeout=timeout)
+            if response.status_code != 200:
+                continue
+            sitemap_pages, nested = parse_sitemap(response.content)
+        except Exception as ex:
+            logger.warning(f"Failed to read sitemap {sitemap_url}: {ex}")
+            continue
+        pages.extend(sitemap_pages)
+        queue.extend(nested)
+    return pages[:max_urls]
+
+
+def read_robots(session, url, timeout=30):
+    # A missing or unreadable robots.txt allows everything
+    parts = urlsplit(url)
+    robots = RobotFileParser(f"{parts.scheme}://{parts.netloc}/robots.txt")
+    try:
+        response = session.get(robots.url, timeout=timeout)
+        lines = response.text.splitlines() if response.status_code == 200 else []
+    except Exception as ex:
+        logger.warning(f"Failed to read {robots.url}: {ex}")
+        lines = []
+    robots.parse(lines)
+    return robots
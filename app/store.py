@@ -0,0 +1,304 @@
+import os
+import glob
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import datetime
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        competitor TEXT NOT NULL,
+        product TEXT,
+        folder TEXT,
+        source TEXT,
+        status TEXT,
+        error TEXT,
+        started_at REAL,
+        finished_at REAL)""",
+    # All crawled pages, also the excluded ones
+    """CREATE TABLE IF NOT EXISTS pages (
+        run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+        url TEXT NOT NULL,
+        title TEXT,
+        content_hash TEXT,
+        PRIMARY KEY (run_id, url))""",
+    """CREATE TABLE IF NOT EXISTS classes (
+        run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+        url TEXT NOT NULL,
+        class TEXT,
+        source TEXT,
+        reused INTEGER,
+        PRIMARY KEY (run_id, url))""",
+    """CREATE TABLE IF NOT EXISTS summaries (
+        run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+        url TEXT NOT NULL,
+        summary TEXT,
+        duplicate_of TEXT,
+        PRIMARY KEY (run_id, url))""",
+    """CREATE TABLE IF NOT EXISTS analyses (
+        run_id INTEGER PRIMARY KEY REFERENCES runs (id) ON DELETE CASCADE,
+        total_summary TEXT,
+        analysis TEXT,
+        prompt_hash TEXT)""",
+    "CREATE INDEX IF NOT EXISTS idx_runs_competitor_started_at ON runs (competitor, started_at)",
+    "CREATE INDEX IF NOT EXISTS idx_runs_started_at ON runs (started_at)",
+    "CREATE INDEX IF NOT EXISTS idx_pages_url ON pages (url)",
+    "CREATE INDEX IF NOT EXISTS idx_pages_content_hash ON pages (content_hash)",
+    "CREATE INDEX IF NOT EXISTS idx_classes_class ON classes (class)",
+]
+
+
+# Results of all analyses in one SQLite database, written after each competitor
+# analysis from the files in its folder. The folders stay the source of the
+# analysis itself; the store answers questions across runs (history of a
+# competitor, what changed between two runs) with indexed queries instead of
+# loading and comparing the JSON files.
+class ResultsStore:
+    def __init__(self, path) -> None:
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            # Readers (the app) don't block the writer (a running analysis)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA foreign_keys=ON")
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    ### Writing ###########################################
+
+    def record_run(self, competitor, folder, product=None, source=None, status='ok', error=None,
+                   started_at=None, finished_at=None):
+        # Stores the run and, if it succeeded, the pages, classes, summaries and analysis of its folder
+        finished_at = finished_at or time.time()
+        pages, summaries, analysis = ([], [], None)
+        if status == 'ok':
+            pages, summaries, analysis = read_folder(folder, competitor)
+
+        with self.lock, self.conn:
+            run_id = self.conn.execute(
+                """INSERT INTO runs (competitor, product, folder, source, status, error, started_at, finished_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (competitor, product, os.path.abspath(folder) if folder else None, source, status, error,
+                 started_at or finished_at, finished_at)).lastrowid
+            self.conn.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                                  [(run_id, page['url'], page.get('title', ''), page.get('content_hash'))
+                                   for page in pages])
+            self.conn.executemany("INSERT OR REPLACE INTO classes VALUES (?, ?, ?, ?, ?)",
+                                  [(run_id, page['url'], page.get('class'), page.get('source'),
+                                    int(bool(page.get('reused')))) for page in pages])
+            self.conn.executemany("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?)",
+                                  [(run_id, item['url'], item.get('summary'), item.get('duplicate_of'))
+                                   for item in summaries])
+            if analysis is not None:
+                self.conn.execute("INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?)",
+                                  (run_id, analysis['total_summary'], analysis['analysis'], analysis['prompt_hash']))
+        logger.info(f"Stored run {run_id} of '{competitor}' ({status}, {len(pages)} pages) in '{self.path}'.")
+        return run_id
+
+    def has_folder(self, folder):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM runs WHERE folder = ?", (os.path.abspath(folder),)).fetchone()
+        return row is not None
+
+    ### Queries ###########################################
+
+    def _all(self, query, params=()):
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(query, params).fetchall()]
+
+    def competitors(self):
+        return [row['competitor'] for row in
+                self._all("SELECT DISTINCT competitor FROM runs ORDER BY competitor")]
+
+    def runs(self, competitor=None, status=None, limit=50):
+        # Latest first, with the number of pages of each run
+        query = """SELECT runs.*, (SELECT COUNT(*) FROM pages WHERE pages.run_id = runs.id) AS num_pages
+                   FROM runs WHERE (? IS NULL OR competitor = ?) AND (? IS NULL OR status = ?)
+                   ORDER BY started_at DESC, id DESC LIMIT ?"""
+        return self._all(query, (competitor, competitor, status, status, limit))
+
+    def get_run(self, run_id):
+        runs = self._all("SELECT * FROM runs WHERE id = ?", (run_id,))
+        return runs[0] if runs else None
+
+    def latest_run(self, competitor, before=None):
+        # The latest successful run, optionally started at or before the timestamp `before`
+        runs = self._all("""SELECT * FROM runs WHERE competitor = ? AND status = 'ok' AND (? IS NULL OR started_at <= ?)
+                            ORDER BY started_at DESC, id DESC LIMIT 1""", (competitor, before, before))
+        return runs[0] if runs else None
+
+    def pages(self, run_id):
+        return self._all("""SELECT pages.url, pages.title, pages.content_hash, classes.class, classes.source,
+                                   classes.reused, summaries.summary, summaries.duplicate_of
+                            FROM pages
+                            LEFT JOIN classes ON classes.run_id = pages.run_id AND classes.url = pages.url
+                            LEFT JOIN summaries ON summaries.run_id = pages.run_id AND summaries.url = pages.url
+                            WHERE pages.run_id = ? ORDER BY pages.url""", (run_id,))
+
+    def analysis(self, run_id):
+        rows = self._all("SELECT * FROM analyses WHERE run_id = ?", (run_id,))
+        return rows[0] if rows else None
+
+    def page_history(self, competitor, url):
+        # The page in every run of the competitor, latest first
+        return self._all("""SELECT runs.id AS run_id, runs.started_at, pages.content_hash, classes.class,
+                                   summaries.summary
+                            FROM pages JOIN runs ON runs.id = pages.run_id
+                            LEFT JOIN classes ON classes.run_id = pages.run_id AND classes.url = pages.url
+                            LEFT JOIN summaries ON summaries.run_id = pages.run_id AND summaries.url = pages.url
+                            WHERE runs.competitor = ? AND pages.url = ?
+                            ORDER BY runs.started_at DESC""", (competitor, url))
+
+    def diff(self, old_run_id, new_run_id):
+        # Pages added, removed, with changed text or with a changed class between two runs
+        page_query = """SELECT new.url, new.title, old.content_hash AS old_hash, new.content_hash AS new_hash,
+                               old_class.class AS old_class, new_class.class AS new_class,
+                               old_summary.summary AS old_summary, new_summary.summary AS new_summary
+                        FROM pages AS new
+                        JOIN pages AS old ON old.run_id = ? AND old.url = new.url
+                        LEFT JOIN classes AS old_class ON old_class.run_id = old.run_id AND old_class.url = old.url
+                        LEFT JOIN classes AS new_class ON new_class.run_id = new.run_id AND new_class.url = new.url
+                        LEFT JOIN summaries AS old_summary ON old_summary.run_id = old.run_id AND old_summary.url = old.url
+                        LEFT JOIN summaries AS new_summary ON new_summary.run_id = new.run_id AND new_summary.url = new.url
+                        WHERE new.run_id = ?
+                          AND (old.content_hash IS NOT new.content_hash OR old_class.class IS NOT new_class.class)
+                        ORDER BY new.url"""
+        only_query = """SELECT pages.url, pages.title, classes.class, summaries.summary
+                        FROM pages
+                        LEFT JOIN classes ON classes.run_id = pages.run_id AND classes.url = pages.url
+                        LEFT JOIN summaries ON summaries.run_id = pages.run_id AND summaries.url = pages.url
+                        WHERE pages.run_id = ? AND pages.url NOT IN (SELECT url FROM pages WHERE run_id = ?)
+                        ORDER BY pages.url"""
+        modified = self._all(page_query, (old_run_id, new_run_id))
+        unchanged = self._all("""SELECT COUNT(*) AS n FROM pages AS new JOIN pages AS old
+                                 ON old.run_id = ? AND old.url = new.url WHERE new.run_id = ?""",
+                              (old_run_id, new_run_id))[0]['n'] - len(modified)
+        old_analysis = self.analysis(old_run_id) or {}
+        new_analysis = self.analysis(new_run_id) or {}
+        return {
+            'old_run': self.get_run(old_run_id),
+            'new_run': self.get_run(new_run_id),
+            'added': self._all(only_query, (new_run_id, old_run_id)),
+            'removed': self._all(only_query, (old_run_id, new_run_id)),
+            'changed': [page for page in modified if page['old_hash'] != page['new_hash']],
+            'reclassified': [page for page in modified if page['old_class'] != page['new_class']],
+            'num_unchanged': unchanged,
+            'analysis_changed': old_analysis.get('analysis') != new_analysis.get('analysis'),
+        }
+
+    def diff_since(self, competitor, since):
+        # Changes of the latest run against the latest run at or before `since` (a timestamp),
+        # or against the run before it without `since`
+        new = self.latest_run(competitor)
+        if new is None:
+            return None
+        if since is None:
+            old = self.latest_run(competitor, before=new['started_at'] - 1e-6)
+        else:
+            old = self.latest_run(competitor, before=since)
+        if old is None or old['id'] == new['id']:
+            return None
+        return self.diff(old['id'], new['id'])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def read_folder(folder, name):
+    # Pages, summaries and analysis of a competitor folder written by `CompetitorAnalyzer.analyze`
+    with open(os.path.join(folder, f'classes_{name}.json'), 'r', encoding='utf-8') as f:
+        pages = json.load(f)
+    summaries = []
+    analysis = {'total_summary': None, 'analysis': None, 'prompt_hash': None}
+    summary_file = os.path.join(folder, f'summaries_{name}.json')
+    if os.path.exists(summary_file):
+        with open(summary_file, 'r', encoding='utf-8') as f:
+            for entry in json.load(f):
+                if 'total_summary' in entry:
+                    analysis['total_summary'] = entry['total_summary']
+                    analysis['prompt_hash'] = entry.get('analysis_prompt_hash')
+                else:
+                    summaries.append(entry)
+    res_file = os.path.join(folder, f'res_competitor_analysis_{name}.txt')
+    if os.path.exists(res_file):
+        with open(res_file, 'r', encoding='utf-8') as f:
+            analysis['analysis'] = f.read()
+    if analysis['total_summary'] is None and analysis['analysis'] is None:
+        analysis = None
+    return pages, summaries, analysis
+
+
+def import_folders(store, root_folder):
+    # Stores the competitor folders of earlier `main.py` runs that are not in the store yet
+    num_imported = 0
+    for run in sorted(glob.glob(os.path.join(root_folder, 'competitor_analyze_*'))):
+        started_at = datetime.datetime.strptime(os.path.basename(run)[len('competitor_analyze_'):],
+                                                '%Y%m%d_%H%M%S').timestamp()
+        for classes_file in sorted(glob.glob(os.path.join(run, '*', 'classes_*.json'))):
+            folder = os.path.dirname(classes_file)
+            name = os.path.basename(folder)
+            if store.has_folder(folder) or not os.path.exists(os.path.join(folder, f'summaries_{name}.json')):
+                continue
+            store.record_run(name, folder, source='import', started_at=started_at,
+                             finished_at=os.path.getmtime(classes_file))
+            num_imported += 1
+    return num_imported
+
+
+def format_diff(diff):
+    old_time = datetime.datetime.fromtimestamp(diff['old_run']['started_at']).strftime('%Y-%m-%d %H:%M')
+    new_time = datetime.datetime.fromtimestamp(diff['new_run']['started_at']).strftime('%Y-%m-%d %H:%M')
+    lines = [f"{diff['new_run']['competitor']}: run {diff['old_run']['id']} ({old_time}) -> "
+             f"run {diff['new_run']['id']} ({new_time}), {diff['num_unchanged']} pages unchanged"]
+    lines += [f"  + {page['url']} [{page['class']}]" for page in diff['added']]
+    lines += [f"  - {page['url']} [{page['class']}]" for page in diff['removed']]
+    lines += [f"  ~ {page['url']}" for page in diff['changed']]
+    lines += [f"  ! {page['url']} [{page['old_class']} -> {page['new_class']}]" for page in diff['reclassified']]
+    if diff['analysis_changed']:
+        lines.append("  The analysis changed.")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Query the results store')
+    parser.add_argument('--db', type=str, default='results/results.sqlite',
+                        help='Path of the results store (default: results/results.sqlite)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    history = commands.add_parser('history', help='List the runs of a competitor')
+    history.add_argument('competitor')
+    history.add_argument('--limit', type=int, default=20)
+    diff = commands.add_parser('diff', help='What changed on a competitor since an earlier run')
+    diff.add_argument('competitor')
+    diff.add_argument('--since', type=str, default=None,
+                      help='Compare with the latest run at or before this date (YYYY-MM-DD), '
+                           'default: the run before the latest one')
+    importer = commands.add_parser('import', help='Store the runs of a root folder written before the store existed')
+    importer.add_argument('root_folder')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.db)
+    if args.command == 'history':
+        for run in store.runs(args.competitor, limit=args.limit):
+            started = datetime.datetime.fromtimestamp(run['started_at']).strftime('%Y-%m-%d %H:%M')
+            print(f"{run['id']:>6}  {started}  {run['status']:<7} {run['num_pages']:>5} pages  {run['folder']}")
+    elif args.command == 'diff':
+        since = datetime.datetime.strptime(args.since, '%Y-%m-%d').timestamp() if args.since else None
+        result = store.diff_since(args.competitor, since)
+        print(format_diff(result) if result else f"No earlier run of '{args.competitor}' to compare with.")
+    else:
+        logger.info(f"Imported {import_folders(store, args.root_folder)} competitor folders.")
+    store.close()
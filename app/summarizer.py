@@ -1,6 +1,7 @@
 import json
 
 from llm import LLMModel
+from tokens import count_tokens, split_tokens, truncate_tokens
 
 
 SYS_PROMPT = """As a Competitor Analyst, your task is to analyze the homepage content of our competitor. 
@@ -9,15 +10,24 @@ SYS_PROMPT = """As a Competitor Analyst, your task is to analyze the homepage co
     and produce following JSON output: 
     {{"summary": <results - range: 150-{num_words} words>}}"""
 
+# Room left for the chat template around the prompts, plus a share of the context
+# for the difference between the counted tokens and those of the served model
+PROMPT_MARGIN = 64
+PROMPT_MARGIN_RATIO = 0.05
+
+
+def prompt_margin(context_tokens):
+    return PROMPT_MARGIN + int(context_tokens * PROMPT_MARGIN_RATIO)
+
 
 class Summarizer:
     def __init__(self, llm_model: LLMModel, nwords=400) -> None:
         self.sys_prompt = SYS_PROMPT.format(num_words=nwords)
         self.llm_model = llm_model
 
-    def summarize(self, content, max_tokens=1200):
+    def summarize(self, content, max_tokens=1200, tag="summarizer"):
         response = self.llm_model.chat(content, self.sys_prompt, 
-                                       max_tokens, 0.)
+                                       max_tokens, 0., tag=tag)
 
         res = response.choices[0].message.content
         # Remove the newline character and the end-of-text identifier
@@ -30,4 +40,67 @@ class Summarizer:
 
         # Parse the JSON string
         res = json.loads(res)
-        return res['summary']
\ No newline at end of file
+        return res['summary']
+
+    def summarize_many(self, contents, max_tokens=1200, tag="summarizer"):
+        # Summarize several texts concurrently, the results keep the order of the texts
+        return self.llm_model.map(lambda content: self.summarize(content, max_tokens, tag), contents)
+
+    def input_budget(self, max_tokens=1200):
+        # Tokens of content that fit in one request next to the prompt and the answer
+        budget = (self.llm_model.context_tokens - count_tokens(self.sys_prompt)
+                  - max_tokens - prompt_margin(self.llm_model.context_tokens))
+        if budget <= 0:
+            raise ValueError(f"Context of {self.llm_model.context_tokens} tokens leaves no room "
+                             f"for content with answers of {max_tokens} tokens.")
+        return budget
+
+    def summarize_pages(self, contents, max_tokens=1200, tag="page_summary"):
+        # Pages longer than the context are split into chunks, all chunks of all
+        # pages are summarized concurrently, then the chunk summaries of each page
+        # are reduced to one summary
+        budget = self.input_budget(max_tokens)
+        chunks, owners = [], []
+        for i, content in enumerate(contents):
+            for chunk in split_tokens(content, budget, overlap=budget // 20):
+                chunks.append(chunk)
+                owners.append(i)
+        summaries = self.summarize_many(chunks, max_tokens, tag)
+
+        per_page = [[] for _ in contents]
+        for i, summary in zip(owners, summaries):
+            per_page[i].append(summary)
+        return self.llm_model.map(
+            lambda page: page[0] if len(page) == 1 else self.reduce(page, max_tokens, tag), per_page)
+
+    def condense(self, texts, budget, max_tokens=1200, tag="summarizer"):
+        # Summarize groups of texts until all of them together fit in `budget` tokens.
+        # Groups are packed greedily up to the request budget and summarized concurrently.
+        request_budget = self.input_budget(max_tokens)
+        texts = [truncate_tokens(text, request_budget) for text in texts if text]
+        while len(texts) > 1 and count_tokens(" .".join(texts)) > budget:
+            groups, group, group_tokens = [], [], 0
+            for text in texts:
+                tokens = count_tokens(text)
+                if group and group_tokens + tokens > request_budget:
+                    groups.append(group)
+                    group, group_tokens = [], 0
+                group.append(text)
+                group_tokens += tokens
+            groups.append(group)
+            if len(groups) == len(texts) and len(texts) > 1:
+                # No two texts fit in one request, pair them up to make progress
+                groups = [texts[i:i + 2] for i in range(0, len(texts), 2)]
+                groups = [[truncate_tokens(text, request_budget // len(group)) for text in group]
+                          for group in groups]
+            texts = self.summarize_many([" .".join(group) for group in groups], max_tokens, tag)
+        if texts and count_tokens(" .".join(texts)) > budget:
+            texts = [truncate_tokens(" .".join(texts), budget)]
+        return texts
+
+    def reduce(self, texts, max_tokens=1200, tag="summarizer"):
+        # One summary of many texts, map-reduce style
+        texts = self.condense(texts, self.input_budget(max_tokens), max_tokens, tag)
+        if not texts:
+            return ""
+        return self.summarize(" .".join(texts), max_tokens, tag)
\ No newline at end of file
@@ -0,0 +1,67 @@
+import threading
+
+
+# tiktoken is optional, without it tokens are estimated from the text length. The
+# estimate errs on the high side: non-English text takes more tokens per character.
+_encoding = None
+_encoding_lock = threading.Lock()
+_encoding_loaded = False
+
+CHARS_PER_TOKEN = 3
+
+
+def get_encoding():
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception:
+                _encoding = None
+            _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN) + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def split_tokens(text, max_tokens, overlap=0):
+    # Split the text into chunks of at most `max_tokens` tokens, consecutive chunks share `overlap` tokens
+    if max_tokens <= 0:
+        raise ValueError(f"max_tokens must be positive, got {max_tokens}.")
+    overlap = min(overlap, max_tokens // 2)
+    step = max_tokens - overlap
+
+    encoding = get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return [text]
+        return [encoding.decode(tokens[start:start + max_tokens])
+                for start in range(0, len(tokens) - overlap, step)]
+
+    # Without a tokenizer, cut at whitespace close to the estimated character positions
+    max_chars, step_chars = max_tokens * CHARS_PER_TOKEN, step * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return [text]
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + max_chars)
+        if end < len(text):
+            space = text.rfind(' ', start + step_chars // 2, end)
+            end = space if space > start else end
+        chunks.append(text[start:end])
+        if end >= len(text):
+            break
+        start = max(start + 1, end - (max_chars - step_chars))
+    return chunks
+
+
+def truncate_tokens(text, max_tokens):
+    return split_tokens(text, max_tokens)[0] if text else text
@@ -1,10 +1,27 @@
-import re
+import os
+import sys
 import random
+import logging
+import zipfile
+from functools import lru_cache
 
-import nltk 
-nltk.download('stopwords')
-from nltk.corpus import stopwords
 
+logger = logging.getLogger(__name__)
+
+# Folders searched for the NLTK stopwords corpus (corpora/stopwords or corpora/stopwords.zip),
+# first a copy next to the project, then the usual NLTK data folders. Nothing is downloaded.
+NLTK_DATA_DIRS = [
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nltk_data'),
+    *[path for path in os.environ.get('NLTK_DATA', '').split(os.pathsep) if path],
+    os.path.expanduser('~/nltk_data'),
+    os.path.join(sys.prefix, 'nltk_data'),
+    os.path.join(sys.prefix, 'share', 'nltk_data'),
+    os.path.join(sys.prefix, 'lib', 'nltk_data'),
+    '/usr/share/nltk_data',
+    '/usr/local/share/nltk_data',
+    '/usr/lib/nltk_data',
+    '/usr/local/lib/nltk_data',
+]
 
 nltk_lan_mapper = {
     'en': 'english',
@@ -15,18 +32,39 @@ nltk_lan_mapper = {
 }
 
 
-def normalize_text(text, languages):
-    pattern = r'(?:https?://|www\.|[^\w.\s])'
-    text = re.sub(pattern, '', text)
-                                    
-    # Remove stopwords from the text
-    # stopwords = []
-    # for lang in languages:
-    #    sws = set(stopwords.words(lang))
-    #    stopwords.append(sws)
-    # text = ' '.join([word for word in text.split() if word.lower() not in stop_words])
-    # logger.info(f"Text content cleaned (len: before={len(text_org)}, after={len(text)}).")
-    return text
+def read_nltk_stopwords(language):
+    # The word list of the NLTK stopwords corpus, read without importing nltk
+    for folder in NLTK_DATA_DIRS:
+        path = os.path.join(folder, 'corpora', 'stopwords', language)
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read().split()
+        zip_path = os.path.join(folder, 'corpora', 'stopwords.zip')
+        if os.path.isfile(zip_path):
+            with zipfile.ZipFile(zip_path) as archive:
+                try:
+                    return archive.read(f'stopwords/{language}').decode('utf-8').split()
+                except KeyError:
+                    continue
+    return None
+
+
+@lru_cache(maxsize=None)
+def get_stopwords(lang) -> frozenset:
+    # Stopwords of a language code (e.g. 'de'), read once per process
+    words = set()
+    if lang in nltk_lan_mapper:
+        nltk_words = read_nltk_stopwords(nltk_lan_mapper[lang])
+        if nltk_words is not None:
+            words.update(nltk_words)
+        elif lang != 'en':
+            logger.warning(f"NLTK stopwords for '{lang}' are not installed, the word cloud may contain them. "
+                           f"Install them with `python -m nltk.downloader -d nltk_data stopwords`.")
+    if lang == 'en':
+        # Also the stopwords of the word cloud package, they don't need a download
+        from wordcloud import STOPWORDS
+        words.update(STOPWORDS)
+    return frozenset(word.casefold() for word in words)
 
 
 def sample_words(words, sample_size):
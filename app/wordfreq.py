@@ -0,0 +1,81 @@
+import re
+import json
+import logging
+import argparse
+from collections import Counter
+
+from utils import get_stopwords
+
+
+logger = logging.getLogger(__name__)
+
+URL_PATTERN = re.compile(r'(?:https?://|www\.)\S+')
+# Words of letters, with inner hyphens or apostrophes ("e-mail", "don't")
+WORD_PATTERN = re.compile(r"[^\W\d_]+(?:['’\-][^\W\d_]+)*")
+
+
+# Term frequencies of a competitor's pages, accumulated page by page. Words are
+# lowercased, stopwords of `languages` and the words of `exclude` (e.g. the
+# company name) are dropped. Beyond `max_terms` distinct words, the rarest are
+# pruned, which keeps the memory bounded on large crawls.
+class WordFrequencies:
+    def __init__(self, languages=(), exclude=(), min_length=3, max_terms=50_000) -> None:
+        self.languages = list(languages)
+        self.stopwords = set().union(*(get_stopwords(lang) for lang in self.languages))
+        self.stopwords.update(word.casefold() for text in exclude for word in WORD_PATTERN.findall(text))
+        self.min_length = min_length
+        self.max_terms = max_terms
+        self.counts = Counter()
+        self.pages = 0
+
+    def add(self, text):
+        text = URL_PATTERN.sub(' ', text)
+        stopwords, min_length = self.stopwords, self.min_length
+        self.counts.update(word for word in (match.casefold() for match in WORD_PATTERN.findall(text))
+                           if len(word) >= min_length and word not in stopwords)
+        self.pages += 1
+        if self.max_terms and len(self.counts) > 2 * self.max_terms:
+            self.counts = Counter(dict(self.counts.most_common(self.max_terms)))
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.pages += other.pages
+        self.languages += [lang for lang in other.languages if lang not in self.languages]
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'languages': self.languages, 'pages': self.pages,
+                       'counts': dict(self.counts.most_common())}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        freqs = cls()
+        freqs.languages = data.get('languages', [])
+        freqs.pages = data.get('pages', 0)
+        freqs.counts = Counter(data['counts'])
+        return freqs
+
+    def render(self, path, max_words=200, width=800, height=800):
+        from wordcloud import WordCloud
+        wordcloud = WordCloud(width=width, height=height, background_color='white', max_words=max_words)
+        wordcloud.generate_from_frequencies(dict(self.counts.most_common(max_words)))
+        wordcloud.to_file(path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Render a word cloud from saved word counts')
+    parser.add_argument('counts', nargs='+',
+                        help='wordfreq_<name>.json files, the counts of several files are merged')
+    parser.add_argument('--out', type=str, default='wordcloud.png',
+                        help='Image to write (default: wordcloud.png)')
+    parser.add_argument('--max-words', type=int, default=200)
+    args = parser.parse_args()
+
+    merged = WordFrequencies.load(args.counts[0])
+    for path in args.counts[1:]:
+        merged.merge(WordFrequencies.load(path))
+    merged.render(args.out, max_words=args.max_words)
+    logger.info(f"Word cloud of {merged.pages} pages saved to '{args.out}'.")
@@ -0,0 +1,110 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from crawler import BeautifulSoupCrawler, AsyncBeautifulSoupCrawler
+from synthetic_site import SyntheticSite, parse_languages
+
+
+def run_crawler(site, url, args, concurrency, out_dir):
+    site.reset_counters()
+    settings = dict(parser=args.parser, seen_set=args.seen_set)
+    if concurrency > 1:
+        crawler_cls = AsyncBeautifulSoupCrawler
+        settings.update(concurrency=concurrency, per_domain_concurrency=concurrency)
+    else:
+        crawler_cls = BeautifulSoupCrawler
+
+    crawler = crawler_cls(
+        name='benchmark',
+        allowed_domains=[url.split('/')[2]],
+        start_urls=[url],
+        languages=args.target_languages.split(','),
+        out_file=os.path.join(out_dir, f'content_{concurrency}.jsonl'),
+        max_pages=args.max_pages,
+        lang_hints=not args.no_lang_hints,
+        **settings
+    )
+
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    crawler.start()
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if args.memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'concurrency': concurrency,
+        'pages': crawler.counter,
+        'seconds': elapsed,
+        'pages_per_sec': crawler.counter / elapsed if elapsed else 0.,
+        'requests': sum(site.requests.values()),
+        'bytes_fetched': site.bytes_served,
+        'duplicate_fetches': site.duplicate_fetches(),
+        'peak_mib': peak / 2**20,
+        'langdetect_sec': crawler.stats['langdetect_sec'],
+        'parse_sec': crawler.stats['parse_sec'] + crawler.stats['text_sec'] + crawler.stats['links_sec'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the crawler against a local synthetic website')
+    parser.add_argument('--pages', type=int, default=500, help='Pages of the synthetic site (default: 500)')
+    parser.add_argument('--fanout', type=int, default=10, help='Links per page (default: 10)')
+    parser.add_argument('--page-words', type=int, default=800, help='Words per page (default: 800)')
+    parser.add_argument('--languages', type=str, default='en=0.7,de=0.3',
+                        help='Language mix of the site (default: en=0.7,de=0.3)')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Response latency (default: 20)')
+    parser.add_argument('--target-languages', type=str, default='en',
+                        help='Languages kept by the crawler (default: en)')
+    parser.add_argument('--max-pages', type=int, default=200, help='Crawl budget (default: 200)')
+    parser.add_argument('--concurrency', type=str, default='1,8',
+                        help='Comma-separated concurrency levels to compare (default: 1,8)')
+    parser.add_argument('--parser', type=str, default='html.parser', help='Parser backend (default: html.parser)')
+    parser.add_argument('--seen-set', type=str, default='set', help='Frontier seen-set: set or bloom (default: set)')
+    parser.add_argument('--lang-hint-share', type=float, default=0.5,
+                        help='Share of pages declaring their language in <html lang>, the others '
+                             'need langdetect (default: 0.5)')
+    parser.add_argument('--no-lang-hints', action='store_true',
+                        help='Ignore <html lang> and always run langdetect')
+    parser.add_argument('--memory', action=argparse.BooleanOptionalAction, default=True,
+                        help='Track peak memory with tracemalloc (slows the crawl down, default: on)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    site = SyntheticSite(args.pages, args.fanout, args.page_words, parse_languages(args.languages),
+                         args.latency_ms, args.seed, lang_hint_share=args.lang_hint_share)
+    server, url = site.serve()
+    print(f"Synthetic site: {args.pages} pages, fanout {args.fanout}, {args.page_words} words/page, "
+          f"languages {args.languages}, latency {args.latency_ms:g} ms")
+    if args.no_lang_hints:
+        print("Language detection: <html lang> ignored, langdetect runs on every page\n")
+    else:
+        print(f"Language detection: {args.lang_hint_share:.0%} of pages declare <html lang>, "
+              f"langdetect runs on the others\n")
+
+    header = (f"{'conc':>4} {'pages':>6} {'time [s]':>9} {'pages/s':>8} {'requests':>9} {'MiB':>7} "
+              f"{'dup':>5} {'peak MiB':>9} {'langdet [s]':>12} {'parse [s]':>10}")
+    print(header)
+    with tempfile.TemporaryDirectory() as out_dir:
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            res = run_crawler(site, url, args, concurrency, out_dir)
+            print(f"{res['concurrency']:>4} {res['pages']:>6} {res['seconds']:>9.2f} {res['pages_per_sec']:>8.1f} "
+                  f"{res['requests']:>9} {res['bytes_fetched'] / 2**20:>7.2f} {res['duplicate_fetches']:>5} "
+                  f"{res['peak_mib']:>9.1f} {res['langdetect_sec']:>12.2f} {res['parse_sec']:>10.2f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
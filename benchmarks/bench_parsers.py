@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import glob
+import argparse
+import hashlib
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from page_parser import parse_html, PARSER_BACKENDS
+
+
+def capture_pages(urls, pages_dir):
+    # Save the raw HTML of the given URLs, so all backends are compared on the same input
+    os.makedirs(pages_dir, exist_ok=True)
+    with requests.Session() as session:
+        for url in urls:
+            response = session.get(url, timeout=30)
+            file_name = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16] + '.html'
+            with open(os.path.join(pages_dir, file_name), 'wb') as f:
+                f.write(response.content)
+            print(f"Captured {url} ({len(response.content)} bytes)")
+
+
+def load_pages(pages_dir):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(pages_dir, '*.html'))):
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    return pages
+
+
+def bench_parser(parser, pages, repeat):
+    # Parse every page once and read its text and links, as the crawler does
+    best = None
+    num_chars = num_links = 0
+    for _ in range(repeat):
+        num_chars = num_links = 0
+        start = time.perf_counter()
+        for content in pages:
+            doc = parse_html(content, parser)
+            num_chars += len(doc.get_text())
+            num_links += len(doc.get_links('https://example.com/'))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, num_chars, num_links
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the HTML parser backends of the crawler')
+    parser.add_argument('--pages', type=str, default='benchmarks/pages',
+                        help='Folder with captured *.html pages (default: benchmarks/pages)')
+    parser.add_argument('--capture', type=str, nargs='*', default=[],
+                        help='URLs to download into the pages folder before running')
+    parser.add_argument('--parsers', type=str, nargs='*', default=PARSER_BACKENDS,
+                        help=f'Backends to compare (default: {" ".join(PARSER_BACKENDS)})')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per backend, the best one is reported (default: 3)')
+    args = parser.parse_args()
+
+    if args.capture:
+        capture_pages(args.capture, args.pages)
+
+    pages = load_pages(args.pages)
+    if not pages:
+        sys.exit(f"No pages found in '{args.pages}', capture some with --capture URL ...")
+    total_bytes = sum(len(p) for p in pages)
+    print(f"{len(pages)} pages, {total_bytes / 1024:.0f} KiB\n")
+
+    print(f"{'parser':<12} {'total [s]':>10} {'ms/page':>10} {'MiB/s':>8} {'chars':>10} {'links':>8}")
+    for backend in args.parsers:
+        try:
+            elapsed, num_chars, num_links = bench_parser(backend, pages, args.repeat)
+        except ImportError as ex:
+            print(f"{backend:<12} skipped ({ex})")
+            continue
+        print(f"{backend:<12} {elapsed:>10.3f} {1000 * elapsed / len(pages):>10.2f} "
+              f"{total_bytes / elapsed / 2**20:>8.1f} {num_chars:>10} {num_links:>8}")
+
+
+if __name__ == "__main__":
+    main()
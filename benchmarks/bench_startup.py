@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+
+def import_once(module):
+    # Import the module in a fresh interpreter, returns the wall time and the -X importtime report
+    code = f"import sys; sys.path.insert(0, {APP_DIR!r}); import {module}" if module else "pass"
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          capture_output=True, text=True, cwd=APP_DIR)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit code {proc.returncode}"
+        raise RuntimeError(error)
+    return elapsed, proc.stderr
+
+
+def slowest_imports(report, top):
+    # (cumulative seconds, module) of the slowest imports, nested imports included
+    imports = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace('import time:', '|').split('|')]
+        imports.append((int(cumulative_us) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def bench_module(module, repeat, baseline):
+    times = []
+    report = ""
+    for _ in range(repeat):
+        elapsed, report = import_once(module)
+        times.append(elapsed - baseline)
+    return statistics.median(times), min(times), report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the cold import time of the application modules')
+    parser.add_argument('--modules', type=str, default='main,app',
+                        help='Comma-separated modules of the app folder (default: main,app)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports shown per module')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Exit with an error if a module takes longer than this (median, in ms)')
+    args = parser.parse_args()
+
+    # Interpreter startup is measured separately and subtracted
+    baseline = statistics.median(import_once(None)[0] for _ in range(args.repeat))
+    print(f"Interpreter startup: {baseline * 1000:.0f} ms (subtracted below)\n")
+
+    too_slow = []
+    for module in args.modules.split(','):
+        try:
+            median, best, report = bench_module(module, args.repeat, baseline)
+        except RuntimeError as ex:
+            print(f"{module}: import failed ({ex})\n")
+            continue
+        print(f"{module}: median {median * 1000:.0f} ms, best {best * 1000:.0f} ms")
+        for cumulative, name in slowest_imports(report, args.top):
+            print(f"  {cumulative * 1000:8.1f} ms  {name}")
+        print()
+        if args.max_ms is not None and median * 1000 > args.max_ms:
+            too_slow.append(module)
+
+    if too_slow:
+        print(f"Slower than {args.max_ms:.0f} ms: {', '.join(too_slow)}")
+        sys.exit(1)
@@ -0,0 +1,149 @@
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+VOCABULARY = {
+    'en': ("the our platform helps teams analyze data with powerful dashboards and reports customers "
+           "use it to understand their business make better decisions and grow faster every day").split(),
+    'de': ("die unsere plattform hilft teams daten mit leistungsstarken dashboards und berichten zu analysieren "
+           "kunden nutzen sie um ihr geschäft zu verstehen bessere entscheidungen zu treffen").split(),
+    'fr': ("notre plateforme aide les équipes à analyser les données avec des tableaux de bord puissants "
+           "les clients l'utilisent pour comprendre leur entreprise et prendre de meilleures décisions").split(),
+}
+
+
+# A generated website served from memory. Page i links to `fanout` random
+# pages, some of the links are variants of the same URL (fragments, tracking
+# parameters, trailing slashes) like on real sites. The language of each page
+# is drawn from `languages` ({code: weight}); only a `lang_hint_share` of the
+# pages declare it in <html lang>, the others need langdetect. Every request is
+# counted, so the benchmark can tell bytes served and duplicate fetches.
+class SyntheticSite:
+    def __init__(self, num_pages=500, fanout=10, page_words=800, languages=None,
+                 latency_ms=0, seed=0, lang_hint_share=0.5) -> None:
+        self.num_pages = num_pages
+        self.fanout = fanout
+        self.page_words = page_words
+        self.languages = languages or {'en': 1.}
+        self.latency = latency_ms / 1000.
+        self.seed = seed
+
+        rnd = random.Random(seed)
+        codes, weights = zip(*self.languages.items())
+        self.page_langs = rnd.choices(codes, weights, k=num_pages)
+        # The home page is in the first language, so the crawl can start
+        self.page_langs[0] = codes[0]
+        self.lang_hint_share = lang_hint_share
+        self.page_hints = [rnd.random() < lang_hint_share for _ in range(num_pages)]
+
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes_served = 0
+
+    def page_path(self, i):
+        lang = self.page_langs[i]
+        return f"/{lang}/section{i % 7}/page{i}"
+
+    def render_page(self, i):
+        rnd = random.Random(self.seed * 1_000_003 + i)
+        lang = self.page_langs[i]
+        words = VOCABULARY[lang]
+        paragraphs = "".join(f"<p>{' '.join(rnd.choice(words) for _ in range(100))}</p>"
+                             for _ in range(max(1, self.page_words // 100)))
+
+        links = []
+        for _ in range(self.fanout):
+            path = self.page_path(rnd.randrange(self.num_pages))
+            variant = rnd.choice(['', '/', '#top', '?utm_source=newsletter', '?utm_medium=web#main'])
+            links.append(f'<a href="{path}{variant}">{rnd.choice(words)}</a>')
+
+        html = f'<html lang="{lang}">' if self.page_hints[i] else '<html>'
+        return (f'<!DOCTYPE html>{html}<head><title>Page {i}</title>'
+                f'<style>body {{font-family: sans-serif}}</style><script>var page = {i};</script></head>'
+                f'<body><nav>{"".join(links[:3])}</nav><h1>Page {i}</h1>{paragraphs}'
+                f'<footer>{"".join(links[3:])}</footer></body></html>')
+
+    def handle(self, path):
+        if self.latency:
+            time.sleep(self.latency)
+        path = path.split('?')[0].split('#')[0].rstrip('/')
+        if path == '':
+            return 200, self.render_page(0).encode('utf-8')
+        if path.rsplit('/', 1)[-1].startswith('page'):
+            try:
+                i = int(path.rsplit('page', 1)[-1])
+            except ValueError:
+                i = -1
+            if 0 <= i < self.num_pages and path == self.page_path(i):
+                return 200, self.render_page(i).encode('utf-8')
+        return 404, b'Not found'
+
+    def serve(self, host='127.0.0.1', port=0):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = site.handle(self.path)
+                with site.lock:
+                    site.requests[self.path.split('#')[0]] += 1
+                    site.bytes_served += len(body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://{host}:{server.server_address[1]}/"
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests.clear()
+            self.bytes_served = 0
+
+    def duplicate_fetches(self):
+        # Requests for a page path that was already served, whatever the query string
+        paths = Counter()
+        for path, count in self.requests.items():
+            paths[path.split('?')[0].rstrip('/')] += count
+        return sum(count - 1 for count in paths.values())
+
+
+def parse_languages(value):
+    # "en=0.7,de=0.3" -> {'en': 0.7, 'de': 0.3}
+    languages = {}
+    for part in value.split(','):
+        code, _, weight = part.partition('=')
+        languages[code.strip()] = float(weight or 1.)
+    return languages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a synthetic website for crawler benchmarks')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--pages', type=int, default=500)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--page-words', type=int, default=800)
+    parser.add_argument('--languages', type=str, default='en=0.7,de=0.3')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--lang-hint-share', type=float, default=0.5,
+                        help='Share of pages declaring their language in <html lang> (default: 0.5)')
+    args = parser.parse_args()
+
+    site = SyntheticSite(args.pages, args.fanout, args.page_words, parse_languages(args.languages), args.latency_ms,
+                         lang_hint_share=args.lang_hint_share)
+    server, url = site.serve(port=args.port)
+    print(f"Serving {args.pages} pages at {url}, press Ctrl+C to stop.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()